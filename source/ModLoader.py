@@ -1,9 +1,9 @@
 
 from __future__ import annotations
-import re, sys, json, types, shutil, importlib.util, time
+import os, re, sys, json, types, shutil, importlib.util, time, hashlib, difflib, bisect, threading, filecmp
 from pathlib import Path
 from collections import defaultdict
-from typing import Dict, List, Tuple, Any, Optional
+from typing import Dict, List, Tuple, Any, Optional, Iterator, Callable
 
 
 # =====================================
@@ -41,10 +41,24 @@ FOLDER_NAME = "WhaleModLoader"
 
 FACTORY_RESET = False # switched automatically by gui
 PURGE_BACKUPS_ONLY = False # switched automatically by gui
+PLAN_MODE = False # switched automatically by gui: dry run, stage outputs + diffs in PLAN_DIR, touch no game files
+JOURNAL_ACTION = "resume" # switched automatically by gui: what to do with an interrupted run, "resume" | "rollback"
+SELECTIVE_RUN = False # switched automatically by gui: only re-apply files touched by mods that changed since the last run
+PARALLEL_PATCHING = False # patch files in worker processes
+PARALLEL_MAX_WORKERS: Optional[int] = None # None = one worker per CPU core
+PIPELINE_DEPTH = 8 # serial runs: files read ahead / waiting to be written while another is patched (0 = one file at a time)
+PREFETCH_WORKERS = 4 # reader threads of the pipeline
+MATCH_ENGINE = "regex" # "regex" | "token": how LINE/FILE_LINE rules find their text (same results)
+FSYNC_POLICY = "batch" # "none" | "batch" (flush all staged files once, at commit) | "always" (flush each file as it is staged)
+PATCH_FUZZ = 2 # FILE_PATCHES: context lines a hunk may drop at each end when it doesn't match as written
+SLOW_RULE_SECONDS = 30.0 # seconds after which a LINE/FILE_LINE rule is reported as slow (0 = off)
 DEF_COMBO_NAME = "Default"
 
 BACKUP_DIR = APP_DIR / "assets" / "backups" / "original_game_files"
 BACKUP_DIR.mkdir(parents=True, exist_ok=True)
+CACHE_DIR = APP_DIR / "assets" / "cache"
+INDEX_CACHE_DIR = CACHE_DIR / "function_index"
+PLAN_DIR = APP_DIR / "assets" / "plan"
 ERROR_COUNT = 0
 WARN_COUNT = 0
 
@@ -71,12 +85,38 @@ def log_banner_error(title: str, lines: list[str]) -> None:
 
 # Tries common encodings used by this game/mod files.
 def read_text_best_effort(p: Path) -> tuple[str, str]:
-    for enc in ("utf-8", "cp1251", "cp1250", "latin-1"):
+    return decode_best_effort(p.read_bytes())
+
+# Same as read_text_best_effort() for bytes already in memory (newlines translated like read_text).
+# Pure ASCII skips the codec trials (reported as utf-8, like before); `hint` is the encoding
+# detected last time for the same file and is tried first.
+def decode_best_effort(raw: bytes, hint: Optional[str] = None) -> tuple[str, str]:
+    text: Optional[str] = None
+    if raw.isascii():
+        text, enc = raw.decode("ascii"), "utf-8"
+    elif hint:
         try:
-            return p.read_text(encoding=enc), enc
-        except UnicodeDecodeError:
+            text, enc = raw.decode(hint), hint
+        except (UnicodeDecodeError, LookupError):
             pass
-    return p.read_bytes().decode("utf-8", errors="replace"), "utf-8"
+    if text is None:
+        for enc in ("utf-8", "cp1251", "cp1250", "latin-1"):
+            try:
+                text = raw.decode(enc)
+                break
+            except UnicodeDecodeError:
+                pass
+        else:
+            text, enc = raw.decode("utf-8", errors="replace"), "utf-8"
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    return text, enc
+
+# Bytes that write_text(text, encoding=enc) would put on disk.
+def encode_output(text: str, enc: str) -> bytes:
+    if os.linesep != '\n':
+        text = text.replace('\n', os.linesep)
+    return text.encode(enc)
 
 
 
@@ -510,6 +550,23 @@ def load_file_replacement(spec: str) -> str:
         return _read_text_best_effort(p)
     return spec
 
+# FILE_REPLACEMENTS of anything but scripts/configs (textures, models, sounds...) are copied byte
+# for byte and never decoded: picked by the target's suffix, or by a NUL byte near the start of the file.
+TEXT_SUFFIXES = (".c", ".h", ".ini", ".txt", ".cfg", ".xml", ".json", ".csv")
+
+# Replacement file a FILE_REPLACEMENTS spec names, if it is a binary one
+def resolve_binary_replacement(rel: str, spec: str) -> Optional[Path]:
+    p = _resolve_in(list(reversed(FILES_SEARCH)), spec)
+    if not p.is_file():
+        return None
+    if not rel.lower().endswith(TEXT_SUFFIXES):
+        return p
+    try:
+        with open(p, "rb") as f:
+            return p if b"\0" in f.read(8192) else None
+    except OSError:
+        return None
+
 def load_line_replacement(spec: str) -> str:
     p = _resolve_in(list(reversed(LINES_SEARCH)), spec)
     if p.exists() and p.is_file():
@@ -540,31 +597,70 @@ def norm_relpath(p: str) -> str:
 
 # In-memory bundle of all rule dictionaries collected from mods.
 class ReplBundle:
-    def __init__(self) -> None:
+    def __init__(self, mod_name: str = "") -> None:
+        self.mod_name = mod_name
         self.line_replacements: Dict[str, Dict[str, List[Tuple[str, str]]]] = {}
         self.function_replacements: Dict[str, Dict[str, str]] = {}
         self.file_line_replacements: Dict[str, List[Tuple[str, str]]] = {}
         self.file_additions: Dict[str, List[Tuple[str, str]]] = {}
         self.file_replacements: Dict[str, str] = {}
+        self.ini_replacements: Dict[str, List[Tuple[str, Optional[str], str, Optional[str]]]] = {}  # rel -> [(section, key, op, value)]
+        self.file_patches: Dict[str, List[str]] = {}  # rel -> [.patch/.diff spec]
+        # Which mod each merged rule came from: key path -> mod name (or list of names, parallel to a rule list)
+        self.origins: Dict[Tuple[str, ...], Any] = {}
 
     # Deep merge with override precedence (later call wins)
     def merge_from(self, other: 'ReplBundle') -> None:
-        def _merge_dict(dst: Dict[str, Any], src: Dict[str, Any]) -> None:
+        owner = other.mod_name
+        def _own(path: Tuple[str, ...], v: Any) -> None:
+            if isinstance(v, dict):
+                for kk, vv in v.items():
+                    _own(path + (kk,), vv)
+            elif isinstance(v, list):
+                self.origins[path] = [owner] * len(v)
+            else:
+                self.origins[path] = owner
+        def _merge_dict(dst: Dict[str, Any], src: Dict[str, Any], path: Tuple[str, ...]) -> None:
             for k, v in src.items():
+                p = path + (k,)
                 if k not in dst:
                     dst[k] = json.loads(json.dumps(v)) if isinstance(v, (dict, list)) else v
+                    _own(p, v)
                     continue
                 if isinstance(dst[k], dict) and isinstance(v, dict):
-                    _merge_dict(dst[k], v)
+                    _merge_dict(dst[k], v, p)
                 elif isinstance(dst[k], list) and isinstance(v, list):
                     dst[k].extend(v)
+                    self.origins.setdefault(p, []).extend([owner] * len(v))
                 else:
                     dst[k] = v
-        _merge_dict(self.line_replacements, other.line_replacements)
-        _merge_dict(self.function_replacements, other.function_replacements)
-        _merge_dict(self.file_line_replacements, other.file_line_replacements)
-        _merge_dict(self.file_additions, other.file_additions)
+                    _own(p, v)
+        _merge_dict(self.line_replacements, other.line_replacements, ("line",))
+        _merge_dict(self.function_replacements, other.function_replacements, ("func",))
+        _merge_dict(self.file_line_replacements, other.file_line_replacements, ("file_line",))
+        _merge_dict(self.file_additions, other.file_additions, ("add",))
+        _merge_dict(self.ini_replacements, other.ini_replacements, ("ini",))
+        _merge_dict(self.file_patches, other.file_patches, ("patch",))
         self.file_replacements.update(other.file_replacements)
+        for k in other.file_replacements:
+            self.origins[("file", k)] = owner
+
+    # Rule dictionaries keyed by target file
+    RULE_KINDS = ("line_replacements", "function_replacements", "file_line_replacements", "file_additions", "file_replacements",
+                  "ini_replacements", "file_patches")
+
+    def rule_dicts(self) -> List[Dict[str, Any]]:
+        return [getattr(self, kind) for kind in self.RULE_KINDS]
+
+    def file_keys(self) -> set:
+        return {k for d in self.rule_dicts() for k in d}
+
+    # Mod name behind a merged rule (index into a rule list, if the path holds one)
+    def origin_of(self, path: Tuple[str, ...], i: int = 0) -> str:
+        o = self.origins.get(path)
+        if isinstance(o, list):
+            return o[i] if i < len(o) else ""
+        return o or ""
 
 
 def _safe_getattr(mod: types.ModuleType, name: str, default: Any) -> Any:
@@ -588,8 +684,17 @@ def _load_replacements_py(py_path: Path, module_name: str) -> Optional[types.Mod
         return None
 
 
+# FUNCTION_REPLACEMENTS swap in one definition per key, so a wildcard function name (which would put the
+# same definition in place of every function it matches) is refused
+def exact_function_keys(funcs: Any, mod_name: str, rel: str) -> Any:
+    if not isinstance(funcs, dict):
+        return funcs
+    for func in [f for f in funcs if is_glob(f)]:
+        log(f"[WARN] FUNCTION_REPLACEMENTS [{mod_name}] {rel}: wildcard function name `{func}` is not supported, ignored")
+    return {f: v for f, v in funcs.items() if not is_glob(f)}
+
 def load_bundle_from_mod(mod: Mod) -> ReplBundle:
-    bundle = ReplBundle()
+    bundle = ReplBundle(mod.name)
     py = _load_replacements_py(mod.replacements_py, module_name=f"mod_{mod.name}_replacements")
     if py is not None:
         lr = _safe_getattr(py, 'LINE_REPLACEMENTS', {})
@@ -597,6 +702,8 @@ def load_bundle_from_mod(mod: Mod) -> ReplBundle:
         flr = _safe_getattr(py, 'FILE_LINE_REPLACEMENTS', {})
         fa = _safe_getattr(py, 'FILE_ADDITIONS', {})
         ff = _safe_getattr(py, 'FILE_REPLACEMENTS', {})
+        ini = _safe_getattr(py, 'INI_REPLACEMENTS', {})
+        fp = _safe_getattr(py, 'FILE_PATCHES', {})
 
         # Normalize keys (paths)
         def norm_paths(d: Dict[str, Any]) -> Dict[str, Any]:
@@ -606,19 +713,226 @@ def load_bundle_from_mod(mod: Mod) -> ReplBundle:
             return out
 
         bundle.line_replacements = { norm_relpath(fp): funcs for fp, funcs in norm_paths(lr).items() }
-        bundle.function_replacements = { norm_relpath(fp): funcs for fp, funcs in norm_paths(fr).items() }        
+        bundle.function_replacements = { k: exact_function_keys(funcs, mod.name, k) for k, funcs in norm_paths(fr).items() }
         bundle.file_line_replacements = norm_paths(flr)
         bundle.file_additions = norm_paths(fa)
         bundle.file_replacements = { norm_relpath(k): v for k, v in ff.items() }
+        bundle.ini_replacements = { k: ini_operations(v, mod.name, k) for k, v in norm_paths(ini).items() }
+        bundle.file_patches = { k: [v] if isinstance(v, str) else list(v) for k, v in norm_paths(fp).items() }
 
     return bundle
 
+# =====================================
+#          GLOB-TARGETED RULES
+# =====================================
+
+# Rule keys may be globs ("Program/quests/**/*.c": "*" and "?" stay inside one folder, "**" spans
+# folders, matched case-insensitively like the game does). A glob key stands for every game file it
+# matches, minus files that can't contain the rule's text. LINE_REPLACEMENTS function names may be
+# wildcards too ("Quest*_Init"); those are matched per file against the functions it defines.
+def is_glob(key: str) -> bool:
+    return any(c in key for c in "*?[")
+
+def glob_regex(pattern: str) -> re.Pattern:
+    out: List[str] = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith("**/", i):
+            out.append("(?:.*/)?")
+            i += 3
+        elif pattern.startswith("**", i):
+            out.append(".*")
+            i += 2
+        elif c == "*":
+            out.append("[^/]*")
+            i += 1
+        elif c == "?":
+            out.append("[^/]")
+            i += 1
+        elif c == "[" and pattern.find("]", i + 2) > 0:
+            j = pattern.find("]", i + 2)
+            cls = pattern[i + 1:j]
+            out.append("[" + ("^" + cls[1:] if cls.startswith("!") else cls).replace("\\", "\\\\") + "]")
+            i = j + 1
+        else:
+            out.append(re.escape(c))
+            i += 1
+    return re.compile("".join(out) + r"\Z", re.IGNORECASE | re.DOTALL)
+
+# Folder part of a glob before its first wildcard: the only subtree that has to be walked
+def glob_base(pattern: str) -> str:
+    parts = pattern.split("/")
+    fixed: List[str] = []
+    for part in parts[:-1]:
+        if is_glob(part):
+            break
+        fixed.append(part)
+    return "/".join(fixed)
+
+# `rel` folder under root, each part matched case-insensitively (None if missing)
+def _find_dir_nocase(root: Path, rel: str) -> Optional[Path]:
+    cur = root
+    for part in filter(None, rel.split("/")):
+        if (cur / part).is_dir():
+            cur = cur / part
+            continue
+        try:
+            cur = next(p for p in cur.iterdir() if p.is_dir() and p.name.lower() == part.lower())
+        except (OSError, StopIteration):
+            return None
+    return cur if cur.is_dir() else None
+
+class GlobExpander:
+    def __init__(self, targets: List[Tuple[str, Path]], backup_dir: Path) -> None:
+        self.targets = targets
+        self.backup_dir = backup_dir
+        self._walked: Dict[str, set] = {}  # walked base folder -> game-relative files under it (all targets)
+
+    # Files under `base` in any target; each folder is walked once per run
+    def _files_under(self, base: str) -> set:
+        base = base.lower()
+        for done, files in self._walked.items():
+            if done == "" or base == done or base.startswith(done + "/"):
+                return {f for f in files if not base or f.lower().startswith(base + "/")}
+        files: set = set()
+        for _, root in self.targets:
+            top = _find_dir_nocase(root, base)
+            if top is None:
+                continue
+            for dirpath, _, names in os.walk(top):
+                rel_dir = Path(dirpath).relative_to(root).as_posix()
+                prefix = "" if rel_dir == "." else rel_dir + "/"
+                files.update(prefix + n for n in names if not n.endswith((STAGED_SUFFIX, PREV_SUFFIX)))
+        self._walked[base] = files
+        return files
+
+    # Literals a file must contain for this rule value to possibly change it (None = no filter)
+    @staticmethod
+    def _needles(kind: str, value: Any) -> Optional[List[List[bytes]]]:
+        groups: List[List[str]] = []
+        if kind == "line_replacements" and isinstance(value, dict):
+            for func, pairs in value.items():
+                for old, _ in pairs:
+                    text = _spec_text(old, resolve_line_spec_to_text)
+                    groups.append(([] if is_glob(func) else [func]) + list(literal_anchors(text)))
+        elif kind == "file_line_replacements" and isinstance(value, list):
+            for old, _ in value:
+                groups.append(list(literal_anchors(_spec_text(old, resolve_line_spec_to_text))))
+        elif kind == "function_replacements" and isinstance(value, dict):
+            groups = [[func] for func in value]
+        else:
+            return None
+        if not groups or any(not g or not all(t.isascii() for t in g) for g in groups):
+            return None  # some rule has nothing to look for (or non-ASCII text): can't rule files out
+        return [[t.encode("ascii") for t in g] for g in groups]
+
+    # Could any target's source of `rel` (backup, else live file) match one of the needle groups?
+    def _may_match(self, rel: str, needles: List[List[bytes]]) -> bool:
+        for label, root in self.targets:
+            src = self.backup_dir / label / rel
+            if not src.exists():
+                src = root / rel
+            try:
+                raw = src.read_bytes()
+            except OSError:
+                continue
+            if any(all(t in raw for t in group) for group in needles):
+                return True
+        return False
+
+    # Bundle with every glob key replaced by the files it stands for. Exact keys of the same mod
+    # merge on top (they win over its globs); the mod's rules still merge with other mods as usual.
+    def expand(self, bundle: ReplBundle) -> ReplBundle:
+        if not any(is_glob(k) for d in bundle.rule_dicts() for k in d):
+            return bundle
+        from concurrent.futures import ThreadPoolExecutor
+        out = ReplBundle(bundle.mod_name)
+        exact = ReplBundle(bundle.mod_name)
+        with ThreadPoolExecutor(max_workers=max(1, PREFETCH_WORKERS)) as pool:
+            for kind in ReplBundle.RULE_KINDS:
+                for key, value in getattr(bundle, kind).items():
+                    if not is_glob(key):
+                        getattr(exact, kind)[key] = value
+                        continue
+                    rx = glob_regex(key)
+                    matched = sorted(f for f in self._files_under(glob_base(key)) if rx.match(f))
+                    needles = self._needles(kind, value)
+                    if needles is not None:
+                        keep = list(pool.map(lambda rel: self._may_match(rel, needles), matched))
+                        candidates = [rel for rel, k in zip(matched, keep) if k]
+                    else:
+                        candidates = matched
+                    log(f"[INFO] Glob rule [{bundle.mod_name}] {key} -> {len(candidates)} file(s)"
+                        + (f" ({len(matched) - len(candidates)} skipped, rule text not found)" if len(candidates) < len(matched) else ""))
+                    part = ReplBundle(bundle.mod_name)
+                    for rel in candidates:
+                        getattr(part, kind)[rel] = value
+                    out.merge_from(part)
+        out.merge_from(exact)
+        return out
+
 # =====================================
 #          PATTERN / PARSING HELPERS
 # =====================================
 
+# Compiled rule patterns live for the whole process: module globals survive importlib.reload()
+# (the GUI reloads before every run). Sources + flags are also kept on disk for cold starts.
+# Bump PATTERN_CACHE_VERSION whenever _build_ws_agnostic_pattern() output changes.
+PATTERN_CACHE_VERSION = 2
+PATTERN_CACHE_PATH = CACHE_DIR / "patterns.json"
+_PATTERN_CACHE: Dict[Tuple[int, str], re.Pattern] = globals().get("_PATTERN_CACHE", {})
+_PATTERN_SOURCES: Dict[str, Tuple[str, int]] = {}  # rule text -> (source, flags), disk layer
+_PATTERN_SOURCES_NEW: Dict[str, Tuple[str, int]] = {}  # built since the last drain_new_pattern_sources()
+_PATTERN_DISK_LOADED = False
+
+def _load_pattern_sources() -> Dict[str, Tuple[str, int]]:
+    global _PATTERN_DISK_LOADED
+    if not _PATTERN_DISK_LOADED:
+        _PATTERN_DISK_LOADED = True
+        try:
+            data = json.loads(PATTERN_CACHE_PATH.read_text("utf-8"))
+            if data.get("version") == PATTERN_CACHE_VERSION:
+                for text, (src, flags) in data.get("patterns", {}).items():
+                    _PATTERN_SOURCES.setdefault(text, (src, int(flags)))
+        except Exception:
+            pass
+    return _PATTERN_SOURCES
+
+# Pattern sources built in this process since the last call (patch jobs hand them back to main)
+def drain_new_pattern_sources() -> Dict[str, Tuple[str, int]]:
+    new = dict(_PATTERN_SOURCES_NEW)
+    _PATTERN_SOURCES_NEW.clear()
+    return new
+
+# Write the sources for this run's rules to disk (rules no longer used drop out)
+def save_pattern_cache(texts: set, new_sources: Dict[str, Tuple[str, int]]) -> None:
+    sources = _load_pattern_sources()
+    sources.update(new_sources)
+    keep = {t: sources[t] for t in texts if t in sources}
+    if not new_sources and len(keep) == len(sources):
+        return
+    try:
+        PATTERN_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        PATTERN_CACHE_PATH.write_text(json.dumps({"version": PATTERN_CACHE_VERSION, "patterns": keep}), encoding="utf-8")
+    except Exception:
+        pass
+
 # Create regex (insensivie to spaces, splits & shit like that)
 def make_ws_agnostic_pattern(text: str) -> re.Pattern:
+    key = (PATTERN_CACHE_VERSION, text)
+    pat = _PATTERN_CACHE.get(key)
+    if pat is None:
+        src = _load_pattern_sources().get(text)
+        if src is not None:
+            pat = re.compile(src[0], src[1])
+        else:
+            pat = _build_ws_agnostic_pattern(text)
+            _PATTERN_SOURCES[text] = _PATTERN_SOURCES_NEW[text] = (pat.pattern, pat.flags)
+        _PATTERN_CACHE[key] = pat
+    return pat
+
+def _build_ws_agnostic_pattern(text: str) -> re.Pattern:
     s = text.strip()
     if not s:
         return re.compile(r"", re.DOTALL)
@@ -636,12 +950,13 @@ def make_ws_agnostic_pattern(text: str) -> re.Pattern:
         pattern_parts.append(escaped2)
     pattern = r'\s*'.join(pattern_parts)
 
+    # Operators next to each other or to a split leave "\s*\s*" runs, which backtrack
+    # polynomially on long whitespace when the match fails; one \s* matches the same text
     try:
-        return re.compile(pattern, re.DOTALL)
+        return re.compile(''.join(_collapse_ws_runs(pattern)), re.DOTALL)
     except re.error:
         fallback = re.escape(s).replace(r'\ ', r'\s*') # simpler fallback
-        return re.compile(fallback, re.DOTALL)
-
+        return re.compile(''.join(_collapse_ws_runs(fallback)), re.DOTALL)
 
 # Keep string replacements that intentionally use backreferences. A fix for SHITTY FUCKIGG AS:KJRELSDFLKDSJ that console sees '\s' in any string and thinks its some backslash, wtf 
 def _safe_re_sub_repl(replacement: str):
@@ -650,22 +965,211 @@ def _safe_re_sub_repl(replacement: str):
     return lambda _m, _r=replacement: _r
 
 
-# Detect function definition header even if '{' is on the same line.
-def is_function_header(line: str, func_name: str) -> bool:
-    pattern = re.compile(rf"^\s*[\w\*\s]*\b{re.escape(func_name)}\b\s*\([^;]*\)\s*(\{{)?\s*$")
-    if not pattern.search(line):
-        return False
-    return not line.rstrip().endswith(';')
-
-def is_function_header_or_start(line: str, func_name: str) -> Tuple[bool, bool]:
-    ln = strip_c_line_comments(line)
-    full = re.compile(rf"^\s*[\w\*\s]*\b{re.escape(func_name)}\b\s*\([^;]*\)\s*(\{{)?\s*$")
-    if full.search(ln) and not ln.rstrip().endswith(';'):
-        return True, True
-    start = re.compile(rf"^\s*[\w\*\s]*\b{re.escape(func_name)}\b\s*\([^;]*$")
-    if start.search(ln) and not ln.rstrip().endswith(';'):
-        return True, False
-    return False, False
+# Literal prefilter for make_ws_agnostic_pattern(): splitting the rule text on whitespace and on the
+# operators that pattern surrounds with \s* leaves pieces every match must contain verbatim.
+_ANCHOR_SPLIT = re.compile(r"[\s=!<>+\-*]+")
+_COMMON_LITERALS = frozenset(("if", "else", "while", "for", "switch", "return", "case", "break", "int", "float",
+                              "string", "bool", "ref", "aref", "object", "void", "true", "false", "i", "j", "n"))
+
+# Rarest literals of a rule (non-keywords first, then longest); empty when the rule has none
+def literal_anchors(text: str, limit: int = 2) -> Tuple[str, ...]:
+    pieces = {p for p in _ANCHOR_SPLIT.split(text.strip()) if p}
+    ranked = sorted(pieces, key=lambda p: (p not in _COMMON_LITERALS, len(p)), reverse=True)
+    return tuple(ranked[:limit])
+
+# Answers "does the text contain all anchors of this rule" for many rules over the same text.
+# Each distinct literal is searched once (str.find runs in C and beats a pure-Python
+# Aho-Corasick automaton here); reset() after the text changes.
+class LiteralPrefilter:
+    def __init__(self, text: str = "") -> None:
+        self.reset(text)
+
+    def reset(self, text: str) -> None:
+        self.text = text
+        self._seen: Dict[str, bool] = {}
+
+    def has_all(self, anchors: Tuple[str, ...]) -> bool:
+        for a in anchors:
+            found = self._seen.get(a)
+            if found is None:
+                found = self._seen[a] = a in self.text
+            if not found:
+                return False
+        return True
+
+
+# =====================================
+#        TOKEN MATCHING ENGINE
+# =====================================
+
+# make_ws_agnostic_pattern() is a chain of literal tokens with \s* between them. The token engine
+# matches that chain directly: find the first token with str.find, then step over whitespace and
+# compare each following token in place. No backtracking, and offsets map 1:1 back to the source.
+_TOKEN_OPS = re.compile(r"(==|!=|<=|>=|=|<|>|[+\-*])")
+_WS_RUN = re.compile(r"\s*")
+_REGEX_ELEM = re.compile(r"\\.|.", re.DOTALL)
+_TOKEN_PATTERNS: Dict[Tuple[int, str], Optional['TokenPattern']] = globals().get("_TOKEN_PATTERNS", {})
+
+class TokenPattern:
+    def __init__(self, tokens: List[str], lead_ws: bool, trail_ws: bool) -> None:
+        self.tokens = tokens
+        self.lead_ws = lead_ws    # pattern starts with \s* -> match swallows whitespace before the first token
+        self.trail_ws = trail_ws  # pattern ends with \s* -> ... and after the last one
+
+    # End offset of a match whose first token starts at p, or -1
+    def _end_at(self, text: str, p: int) -> int:
+        end = p + len(self.tokens[0])
+        for tok in self.tokens[1:]:
+            end = _WS_RUN.match(text, end).end()
+            if not text.startswith(tok, end):
+                return -1
+            end += len(tok)
+        if self.trail_ws:
+            end = _WS_RUN.match(text, end).end()
+        return end
+
+    # Leftmost non-overlapping matches, like re.finditer
+    def spans(self, text: str, pos: int = 0) -> Iterator[Tuple[int, int]]:
+        first = self.tokens[0]
+        p = text.find(first, pos)
+        while p != -1:
+            end = self._end_at(text, p)
+            if end < 0:
+                p = text.find(first, p + 1)
+                continue
+            start = p
+            if self.lead_ws:
+                while start > pos and text[start - 1].isspace():
+                    start -= 1
+            yield start, end
+            pos = end
+            p = text.find(first, pos)
+
+    # Same contract as re.Pattern.subn() with a literal replacement
+    def subn(self, replacement: str, text: str, count: int = 0) -> Tuple[str, int]:
+        out: List[str] = []
+        last = n = 0
+        for start, end in self.spans(text):
+            out.append(text[last:start])
+            out.append(replacement)
+            last = end
+            n += 1
+            if n == count:
+                break
+        if not n:
+            return text, 0
+        out.append(text[last:])
+        return ''.join(out), n
+
+def _collapse_ws_runs(pattern: str) -> List[str]:
+    out: List[str] = []
+    elems = _REGEX_ELEM.findall(pattern)
+    i = 0
+    while i < len(elems):
+        if elems[i] == "\\s" and i + 1 < len(elems) and elems[i + 1] == "*":
+            if out[-2:] != ["\\s", "*"]:
+                out += ["\\s", "*"]
+            i += 2
+        else:
+            out.append(elems[i])
+            i += 1
+    return out
+
+# Token form of make_ws_agnostic_pattern(text). None when the regex is not a plain token chain
+# (empty rule, compile fallback, odd escapes) - callers then use the regex.
+def token_pattern(text: str) -> Optional[TokenPattern]:
+    key = (PATTERN_CACHE_VERSION, text)
+    if key in _TOKEN_PATTERNS:
+        return _TOKEN_PATTERNS[key]
+    tp = None
+    s = text.strip()
+    if s:
+        tokens = [t for part in re.split(r"\s+", s) for t in _TOKEN_OPS.split(part) if t]
+        lead, trail = bool(_TOKEN_OPS.fullmatch(tokens[0])), bool(_TOKEN_OPS.fullmatch(tokens[-1]))
+        chain = (r"\s*" if lead else "") + r"\s*".join(map(re.escape, tokens)) + (r"\s*" if trail else "")
+        # Only take over when both describe exactly the same regex
+        if _collapse_ws_runs(chain) == _collapse_ws_runs(make_ws_agnostic_pattern(text).pattern):
+            tp = TokenPattern(tokens, lead, trail)
+    _TOKEN_PATTERNS[key] = tp
+    return tp
+
+# Apply one whitespace-agnostic rule with the selected engine -> (new text, replacements)
+def rule_subn(old_text: str, replacement: str, text: str, count: int = 0, engine: str = "regex") -> Tuple[str, int]:
+    repl = _safe_re_sub_repl(replacement)
+    if engine == "token" and callable(repl):
+        tp = token_pattern(old_text)
+        if tp is not None:
+            return tp.subn(replacement, text, count)
+    return make_ws_agnostic_pattern(old_text).subn(repl, text, count=count)
+
+# Slow-rule report for the rules of one scope (SLOW_RULE_SECONDS). Rules are never aborted: generated
+# patterns are literal chains joined by single \s*, which match in linear time.
+class RuleWatch:
+    def __init__(self, threshold: float) -> None:
+        self.threshold = threshold
+        self.slow: List[Tuple[int, float]] = []  # (rule index, seconds)
+
+    def subn(self, k: int, old_text: str, replacement: str, text: str, count: int, engine: str) -> Tuple[str, int]:
+        t0 = time.perf_counter()
+        out = rule_subn(old_text, replacement, text, count, engine)
+        elapsed = time.perf_counter() - t0
+        if 0 < self.threshold < elapsed:
+            self.slow.append((k, elapsed))
+        return out
+
+# Apply all rules of one scope (a function, or the whole file) in rule order, each on the text
+# the previous ones left -> (new text, hits per rule)
+def apply_rules(text: str, rules: List[Tuple[str, str]], count: int, engine: str,
+                anchors: Dict[str, Tuple[str, ...]], watch: Optional[RuleWatch] = None) -> Tuple[str, List[int]]:
+    prefilter = LiteralPrefilter(text)
+    hits = [0] * len(rules)
+    for k, (old, replacement) in enumerate(rules):
+        if not prefilter.has_all(anchors.get(old, ())):
+            continue
+        if watch is not None:
+            text, n = watch.subn(k, old, replacement, text, count, engine)
+        else:
+            text, n = rule_subn(old, replacement, text, count, engine)
+        if n:
+            hits[k] = n
+            prefilter.reset(text)
+    return text, hits
+
+
+_HEADER_HEAD_OK = re.compile(r"[\w\*\s]*")
+_HEADER_NAME = re.compile(r"(\w+)\s*$")
+_HEADER_FULL_TAIL = re.compile(r"\([^;]*\)\s*(\{)?\s*$")
+_HEADER_START_TAIL = re.compile(r"\([^;]*$")
+
+# Header detector for all functions requested in one file (built once per file, not per line/function).
+# A header is `[type words] name(` at the start of a line, not ending in ';' (a call or prototype); it is
+# complete when its ')' (and maybe '{') is on the same line. The name is the word right before the
+# first '(', so one split + one dict lookup finds it for every requested function at once.
+class FunctionHeaderMatcher:
+    def __init__(self, names) -> None:
+        self.names = frozenset(n for n in names if not is_glob(n))
+        self.patterns = [glob_regex(n) for n in names if is_glob(n)]  # wildcard function names
+
+    def wanted(self, name: str) -> bool:
+        return name in self.names or any(p.match(name) for p in self.patterns)
+
+    # Returns (func_name or None, header_complete)
+    def match(self, line: str) -> Tuple[Optional[str], bool]:
+        if not (self.names or self.patterns) or '(' not in line:
+            return None, False
+        ln = strip_c_line_comments(line) if '/' in line else line
+        idx = ln.find('(')
+        if idx < 0 or ln.rstrip().endswith(';'):
+            return None, False
+        head = ln[:idx]
+        m = _HEADER_NAME.search(head)
+        if m is None or not self.wanted(m.group(1)) or not _HEADER_HEAD_OK.fullmatch(head):
+            return None, False
+        if _HEADER_FULL_TAIL.match(ln, idx):
+            return m.group(1), True
+        if _HEADER_START_TAIL.match(ln, idx):
+            return m.group(1), False
+        return None, False
 
 # Remove //comments at the end of the line
 def strip_c_line_comments(s: str) -> str:
@@ -674,6 +1178,212 @@ def strip_c_line_comments(s: str) -> str:
     return s
 
 
+# =====================================
+#       FUNCTION SPAN INDEX (StormC)
+# =====================================
+
+FUNCTION_INDEX_VERSION = 1
+
+# Top level: comments, strings, braces, parens, ';' and identifiers followed by '('
+_LEX_TOP = re.compile(
+    r'''(?P<cmt>//[^\n]*|/\*.*?\*/)|(?P<open_cmt>/\*)|(?P<str>"(?:\\.|[^"\\\n])*"?|'(?:\\.|[^'\\\n])*'?)'''
+    r'''|\b(?P<id>[A-Za-z_]\w*)(?=\s*\()|(?P<ch>[{}();])''', re.DOTALL)
+# Inside a body only braces matter (plus everything that can hide them)
+_LEX_BODY = re.compile(
+    r'''(?P<cmt>//[^\n]*|/\*.*?\*/)|(?P<open_cmt>/\*)|(?P<str>"(?:\\.|[^"\\\n])*"?|'(?:\\.|[^'\\\n])*'?)|(?P<ch>[{}])''', re.DOTALL)
+_LEX_SKIP = re.compile(r'(?:\s+|//[^\n]*|/\*.*?\*/)*', re.DOTALL)
+_LEX_KEYWORDS = frozenset(("if", "else", "while", "for", "switch", "return", "sizeof", "case"))
+
+# Single-pass lexer: function name -> [(header, body, end), ...] as offsets into `text`.
+# header = start of the line holding the name, body = the '{', end = just past the matching '}'.
+# Returns None when the file can't be lexed cleanly (unterminated comment, unbalanced braces).
+def build_function_index(text: str) -> Optional[Dict[str, List[Tuple[int, int, int]]]]:
+    index: Dict[str, List[Tuple[int, int, int]]] = {}
+    pos = 0
+    n = len(text)
+    cand: Optional[Tuple[str, int]] = None  # (name, name offset) waiting for its ')'
+    paren = 0
+    while pos < n:
+        m = _LEX_TOP.search(text, pos)
+        if m is None:
+            break
+        pos = m.end()
+        kind = m.lastgroup
+        if kind in ("cmt", "str"):
+            continue
+        if kind == "open_cmt":
+            return None
+        if kind == "id":
+            if paren == 0 and m.group("id") not in _LEX_KEYWORDS:
+                cand = (m.group("id"), m.start())
+            continue
+        ch = m.group("ch")
+        if ch == '(':
+            paren += 1
+            continue
+        if ch == ')':
+            paren = max(0, paren - 1)
+            if paren == 0 and cand is not None:
+                # definition only if the next real token is '{'
+                k = _LEX_SKIP.match(text, pos).end()
+                if k < n and text[k] == '{':
+                    name, name_at = cand
+                    header = text.rfind('\n', 0, name_at) + 1
+                    end = _skip_function_body(text, k)
+                    if end is None:
+                        return None
+                    index.setdefault(name, []).append((header, k, end))
+                    pos = end
+                cand = None
+            continue
+        if ch == '}':
+            return None  # stray '}' at top level
+        cand = None if paren == 0 else cand
+        if ch == '{':
+            end = _skip_function_body(text, m.start())  # struct/initializer block
+            if end is None:
+                return None
+            pos = end
+    return index
+
+# Offset just past the '}' matching the '{' at `open_at`, or None if it never closes.
+def _skip_function_body(text: str, open_at: int) -> Optional[int]:
+    depth = 0
+    pos = open_at
+    while True:
+        m = _LEX_BODY.search(text, pos)
+        if m is None:
+            return None
+        pos = m.end()
+        kind = m.lastgroup
+        if kind == "open_cmt":
+            return None
+        if kind != "ch":
+            continue
+        depth += 1 if m.group("ch") == '{' else -1
+        if depth == 0:
+            return pos
+
+def _index_cache_path(content_hash: str) -> Path:
+    return INDEX_CACHE_DIR / f"{content_hash}.json"
+
+# Function index for a backup file, cached on disk by the content hash of its bytes.
+def load_function_index(content_hash: str, text: str) -> Optional[Dict[str, List[Tuple[int, int, int]]]]:
+    p = _index_cache_path(content_hash)
+    try:
+        data = json.loads(p.read_text("utf-8"))
+        if data.get("version") == FUNCTION_INDEX_VERSION and data.get("length") == len(text):
+            if data.get("functions") is None:
+                return None
+            return {k: [tuple(s) for s in v] for k, v in data["functions"].items()}
+    except Exception:
+        pass
+    index = build_function_index(text)
+    try:
+        p.parent.mkdir(parents=True, exist_ok=True)
+        p.write_text(json.dumps({"version": FUNCTION_INDEX_VERSION, "length": len(text), "functions": index}), encoding="utf-8")
+    except Exception:
+        pass
+    return index
+
+def clear_function_index_cache() -> None:
+    shutil.rmtree(INDEX_CACHE_DIR, ignore_errors=True)
+
+# Split source into (function name or None, start, end) chunks using the span index.
+# Chunks cover whole lines, the same way the line-based capture did.
+def iter_function_chunks_indexed(text: str, index: Dict[str, List[Tuple[int, int, int]]], names) -> Iterator[Tuple[Optional[str], int, int]]:
+    spans = sorted((sp[0], sp[2], name) for name in names for sp in index.get(name, ()))
+    pos = 0
+    for header, end, name in spans:
+        if header < pos:
+            continue  # shares a line with the previous function
+        nl = text.find('\n', end)
+        chunk_end = len(text) if nl < 0 else nl + 1
+        if header > pos:
+            yield None, pos, header
+        yield name, header, chunk_end
+        pos = chunk_end
+    if pos < len(text):
+        yield None, pos, len(text)
+
+# Offsets for chunks that come as strings (they cover the text in order)
+def chunk_offsets(chunks: Iterator[Tuple[Optional[str], str]]) -> Iterator[Tuple[Optional[str], int, int]]:
+    pos = 0
+    for name, chunk in chunks:
+        yield name, pos, pos + len(chunk)
+        pos += len(chunk)
+
+# Legacy line-based capture, used when the lexer can't index a file.
+def iter_function_chunks_by_lines(text: str, header_matcher: FunctionHeaderMatcher) -> Iterator[Tuple[Optional[str], str]]:
+    in_function: Optional[str] = None
+    brace_level = 0
+    wait_for_brace = False
+    buffer_lines: List[str] = []
+
+    source_lines_iter = iter(text.splitlines(keepends=True))
+    for raw_line in source_lines_iter:
+        line = raw_line
+        stripped = line.rstrip('\n')
+
+        if in_function is None:
+            detected, header_complete = header_matcher.match(stripped)
+            if detected is None:
+                yield None, line
+                continue
+
+            # Start capture
+            in_function = detected
+            buffer_lines = [line]
+
+            # No ')' on this line yet: keep pulling header lines until the ')' closes
+            if not header_complete:
+                ln = strip_c_line_comments(stripped)
+                paren_depth = ln.count('(') - ln.count(')')
+                continue_capture = True
+                while continue_capture:
+                    try:
+                        next_raw = next(source_lines_iter)
+                    except StopIteration:
+                        break
+                    buffer_lines.append(next_raw)
+                    nr = next_raw.rstrip('\n')
+                    lnc = strip_c_line_comments(nr)
+                    paren_depth += lnc.count('(') - lnc.count(')')
+                    if paren_depth <= 0:
+                        continue_capture = False
+                wait_for_brace = True
+                continue
+
+            if '{' in stripped and not stripped.strip().endswith(';'):
+                brace_level = stripped.count('{') - stripped.count('}')
+                wait_for_brace = False
+            else:
+                wait_for_brace = True
+            continue
+
+        # Inside function capture
+        buffer_lines.append(line)
+
+        if wait_for_brace:
+            if '{' in stripped:
+                brace_level = stripped.count('{') - stripped.count('}')
+                wait_for_brace = False
+        else:
+            code_part = stripped.split("//", 1)[0]   # cut line comment
+            brace_level += code_part.count("{") - code_part.count("}")
+
+        if brace_level <= 0 and not wait_for_brace:
+            yield in_function, ''.join(buffer_lines)
+            in_function = None
+            buffer_lines = []
+            brace_level = 0
+            wait_for_brace = False
+
+    # Unclosed function -> flush untouched
+    if buffer_lines:
+        yield None, ''.join(buffer_lines)
+
+
 # =====================================
 #     MISC HELPERS
 # =====================================
@@ -761,7 +1471,14 @@ def perform_factory_reset(backup_root: Path, targets: List[Tuple[str, Path]]) ->
         dest = dest_root / rel_path
         try:
             dest.parent.mkdir(parents=True, exist_ok=True)
-            shutil.copy2(f, dest)
+            tmp = staged_path_for(dest)
+            try:
+                transfer_file(f, tmp)
+                shutil.copystat(f, tmp)
+                os.replace(tmp, dest)  # the game file is only touched once the copy is complete
+            except Exception:
+                tmp.unlink(missing_ok=True)
+                raise
             log(f"[INFO] Backup restored: {f.name}")
             try:
                 f.unlink()
@@ -783,6 +1500,7 @@ def perform_factory_reset(backup_root: Path, targets: List[Tuple[str, Path]]) ->
             log("[INFO] All original backup files removed.")
     except Exception:
         pass
+    clear_ledger()
 
 def purge_all_backups(backup_root: Path) -> None:
     if not backup_root.exists():
@@ -816,12 +1534,17 @@ def purge_all_backups(backup_root: Path) -> None:
             log("[INFO] All backup files removed, backup directory deleted.")
     except Exception:
         pass
+
+    # Cached function spans and run fingerprints belong to the purged backups
+    clear_function_index_cache()
+    clear_ledger()
     
     _sync_stored_buildid_to_current()
 
 
 # Restore files from BACKUP_DIR when no enabled mod targets them anymore.
-def restore_orphaned_files(backup_root: Path, targets: List[Tuple[str, Path]], active_file_keys: set[str]) -> int:
+def restore_orphaned_files(backup_root: Path, targets: List[Tuple[str, Path]], active_file_keys: set[str], dry_run: bool = False,
+                           journal: Optional["RunJournal"] = None) -> int:
     if not backup_root.exists():
         return 0
 
@@ -852,18 +1575,29 @@ def restore_orphaned_files(backup_root: Path, targets: List[Tuple[str, Path]], a
         dest = dest_root / rel_path
 
         try:
-            dest.parent.mkdir(parents=True, exist_ok=True)
+            if not dry_run:
+                dest.parent.mkdir(parents=True, exist_ok=True)
 
             # Avoid noisy logs if already identical
             try:
-                if dest.exists() and dest.read_bytes() == f.read_bytes():
+                if dest.exists() and dest.stat().st_size == f.stat().st_size and filecmp.cmp(dest, f, shallow=False):
                     continue
             except Exception:
                 pass
 
-            shutil.copy2(f, dest)
             label = "/".join(label_key)
             log(f"==> {rel_norm} ({label})")
+            if dry_run:
+                log(f"\t     [BACKUP RESTORED]    (plan) Would restore, no enabled mod targets this file now")
+                restored += 1
+                continue
+            if journal is not None:
+                journal.keep_previous(dest)
+                journal.record("restore", sync=True, target=str(dest))
+            tmp = staged_path_for(dest)
+            transfer_file(f, tmp)
+            shutil.copystat(f, tmp)
+            os.replace(tmp, dest)
             log(f"\t     [BACKUP RESTORED]    No enabled mod targets this file now")
             restored += 1
         except Exception as e:
@@ -874,12 +1608,1731 @@ def restore_orphaned_files(backup_root: Path, targets: List[Tuple[str, Path]], a
 
 
 
+# =====================================
+#       INCREMENTAL RUN LEDGER
+# =====================================
+
+# Per "label/rel" fingerprints of the last run, stored next to .wml_state.json.
+# Entry: source hash (+ stat), rules hash, assets hash, output hash and the stats logged for it.
+LEDGER_PATH = STATE_PATH.parent / ".wml_ledger.json"
+LEDGER_VERSION = 3
+
+def file_digest(data: bytes) -> str:
+    return hashlib.sha1(data).hexdigest()
+
+# file_digest() of a file's content, read in chunks (large assets never sit in memory whole)
+def path_digest(p: Path) -> str:
+    h = hashlib.sha1()
+    with open(p, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def _stat_key(p: Path) -> Optional[List[int]]:
+    try:
+        st = p.stat()
+        return [st.st_size, st.st_mtime_ns]
+    except OSError:
+        return None
+
+def _load_ledger() -> Dict[str, dict]:
+    try:
+        data = json.loads(LEDGER_PATH.read_text("utf-8"))
+        if isinstance(data, dict) and data.get("version") == LEDGER_VERSION:
+            files = data.get("files")
+            return files if isinstance(files, dict) else {}
+    except Exception:
+        pass
+    return {}
+
+def _save_ledger(files: Dict[str, dict]) -> None:
+    try:
+        LEDGER_PATH.write_text(json.dumps({"version": LEDGER_VERSION, "files": files}, ensure_ascii=False), encoding="utf-8")
+    except Exception:
+        pass
+
+def clear_ledger() -> None:
+    try:
+        LEDGER_PATH.unlink()
+    except OSError:
+        pass
+
+# Fingerprint of a backup-sourced job. The backup is only re-hashed when its size/mtime changed.
+def _job_fingerprint(rules: "FileRules", backup_path: Path, prev: Optional[dict]) -> Tuple[Optional[dict], Optional[bytes]]:
+    stat = _stat_key(backup_path)
+    if stat is None:
+        return None, None
+    raw: Optional[bytes] = None
+    fp = {"source_stat": stat, "rules": rules.rules_hash, "assets": rules.assets_hash}
+    if prev and prev.get("source_stat") == stat and prev.get("source"):
+        fp["source"] = prev["source"]
+        if prev.get("encoding"):
+            fp["encoding"] = prev["encoding"]  # detected encoding of this same backup
+    elif rules.file_copy is not None:
+        fp["source"] = path_digest(backup_path)  # binary replacement: the source itself is never needed
+    else:
+        raw = backup_path.read_bytes()
+        fp["source"] = file_digest(raw)
+    return fp, raw
+
+# True when nothing that feeds this job changed and the live file is still what we wrote.
+# The live file is only re-hashed when its size/mtime differ from what we recorded after writing it.
+def _is_up_to_date(prev: Optional[dict], fp: Optional[dict], full_path: Path) -> bool:
+    if not prev or not fp:
+        return False
+    if any(prev.get(k) != fp[k] for k in ("source", "rules", "assets")):
+        return False
+    live_stat = _stat_key(full_path)
+    if live_stat is None:
+        return False
+    if live_stat == prev.get("output_stat"):
+        return True
+    try:
+        return path_digest(full_path) == prev.get("output")
+    except OSError:
+        return False
+
+
+# =====================================
+#     PATCHED DOCUMENT (piece table)
+# =====================================
+
+# File content during patching: a list of (buffer, start, end) pieces pointing into the source text
+# and the inserted texts. Used from the function pass on: unchanged chunks, rewritten functions and
+# FILE_ADDITIONS only touch the piece list, and marker lookups search across pieces. Stages that
+# need the whole text (FILE_LINE rules when some rule's anchors are present, INI rules, a BEGIN
+# marker found) build it with text(), cached until the next edit. Function-level edits and
+# FILE_PATCHES (before the function pass) work on plain strings.
+class PieceTable:
+    def __init__(self, text: str = "") -> None:
+        self._pieces: List[Tuple[str, int, int]] = [(text, 0, len(text))] if text else []
+        self._len = len(text)
+        self._text: Optional[str] = text
+
+    def __len__(self) -> int:
+        return self._len
+
+    def _changed(self, delta: int) -> None:
+        self._len += delta
+        self._text = None
+
+    def append(self, buf: str, start: int = 0, end: Optional[int] = None) -> None:
+        end = len(buf) if end is None else end
+        if end > start:
+            self._pieces.append((buf, start, end))
+            self._changed(end - start)
+
+    def prepend(self, buf: str) -> None:
+        if buf:
+            self._pieces.insert(0, (buf, 0, len(buf)))
+            self._changed(len(buf))
+
+    def text(self) -> str:
+        if self._text is None:
+            self._text = ''.join(b if (s == 0 and e == len(b)) else b[s:e] for b, s, e in self._pieces)
+            self._pieces = [(self._text, 0, self._len)] if self._len else []
+        return self._text
+
+    # Replace sorted, non-overlapping (start, end, replacement) spans given in text() offsets
+    def replace_spans(self, edits: List[Tuple[int, int, str]]) -> None:
+        if not edits:
+            return
+        offsets: List[int] = []
+        pos = 0
+        for b, s, e in self._pieces:
+            offsets.append(pos)
+            pos += e - s
+
+        def _slice(lo: int, hi: int) -> Iterator[Tuple[str, int, int]]:
+            i = max(0, bisect.bisect_right(offsets, lo) - 1)
+            while i < len(self._pieces) and offsets[i] < hi:
+                b, s, e = self._pieces[i]
+                a0 = s + max(0, lo - offsets[i])
+                a1 = s + min(e - s, hi - offsets[i])
+                if a1 > a0:
+                    yield b, a0, a1
+                i += 1
+
+        out: List[Tuple[str, int, int]] = []
+        pos = 0
+        for start, end, replacement in edits:
+            out.extend(_slice(pos, start))
+            if replacement:
+                out.append((replacement, 0, len(replacement)))
+            pos = end
+        out.extend(_slice(pos, self._len))
+        self._pieces = out
+        self._changed(sum(len(r) - (end - start) for start, end, r in edits))
+
+    # Substring test across piece boundaries without building the text
+    def __contains__(self, sub: str) -> bool:
+        if self._text is not None or not sub:
+            return sub in self.text()
+        k = len(sub) - 1
+        carry = ""
+        for b, s, e in self._pieces:
+            if b.find(sub, s, e) != -1:
+                return True
+            if k:
+                if sub in carry + b[s:min(e, s + k)]:
+                    return True
+                carry = (carry + b[max(s, e - k):e])[-k:]
+        return False
+
+    def startswith(self, prefix: str) -> bool:
+        head = ""
+        for b, s, e in self._pieces:
+            head += b[s:min(e, s + len(prefix) - len(head))]
+            if len(head) >= len(prefix):
+                break
+        return head == prefix
+
+    def endswith(self, suffix: str) -> bool:
+        tail = ""
+        for b, s, e in reversed(self._pieces):
+            tail = b[max(s, e - (len(suffix) - len(tail))):e] + tail
+            if len(tail) >= len(suffix):
+                break
+        return tail == suffix
+
+
+# =====================================
+#        FILE ADDITION MARKERS
+# =====================================
+
+# FILE_ADDITIONS are wrapped in sentinel comments naming the mod, a stable id and a content hash:
+#   // WML-ADDITION BEGIN [Mod Name] end#0 1a2b3c4d5e6f
+#   ...addition...
+#   // WML-ADDITION END [Mod Name] end#0
+# Presence checks only look for the markers; a changed addition replaces its old block.
+# Files without a known comment syntax keep the plain "text already in file" check.
+ADDITION_COMMENT = {".c": "//", ".h": "//", ".ini": ";"}
+
+def _addition_block(comment: str, mod: str, add_id: str, digest: str, addition: str) -> str:
+    body = addition if addition.endswith('\n') else addition + '\n'
+    return (f"{comment} WML-ADDITION BEGIN [{mod}] {add_id} {digest}\n" + body +
+            f"{comment} WML-ADDITION END [{mod}] {add_id}\n")
+
+# Add one FILE_ADDITIONS entry to doc -> "add", "update" (old block replaced) or "skip" (our block
+# with the same content is there already). Presence is decided by the markers only.
+def add_file_addition(doc: PieceTable, rel: str, where: str, addition: str, mod: str, add_id: str) -> str:
+    comment = ADDITION_COMMENT.get(Path(rel).suffix.lower())
+    if comment is None:
+        if addition in doc:
+            return "skip"
+        block = addition
+    else:
+        digest = file_digest(addition.encode("utf-8"))[:12]
+        begin = f"{comment} WML-ADDITION BEGIN [{mod}] {add_id} "
+        if begin in doc:
+            text = doc.text()
+            start = text.find(begin)
+            eol = text.find('\n', start)
+            if text[start + len(begin):eol if eol >= 0 else len(text)].strip() == digest:
+                return "skip"
+            end_marker = f"{comment} WML-ADDITION END [{mod}] {add_id}"
+            end = text.find(end_marker, start)
+            if end >= 0:
+                nl = text.find('\n', end)
+                end = len(text) if nl < 0 else nl + 1
+                doc.replace_spans([(start, end, _addition_block(comment, mod, add_id, digest, addition))])
+                return "update"
+            # Damaged block (END marker gone): drop the stale BEGIN line, add a fresh block below
+            doc.replace_spans([(start, len(text) if eol < 0 else eol + 1, "")])
+        block = _addition_block(comment, mod, add_id, digest, addition)
+
+    if where == 'start':
+        sep = '\n' if (not doc.startswith('\n')) and (not block.endswith('\n')) and len(doc) else ''
+        doc.prepend(block + sep)
+    else:
+        sep = '\n' if (not doc.endswith('\n')) and (not block.startswith('\n')) and len(doc) else ''
+        doc.append(sep + block)
+    return "add"
+
+# FILE_ADDITIONS positions anchored to a function: "before:Func", "after:Func" (around the whole
+# definition), "start:Func" (first line of the body) and "end:Func" (just above the closing brace).
+ANCHORED_POSITIONS = ("before", "after", "start", "end")
+
+def parse_anchored_position(position: Any) -> Optional[Tuple[str, str]]:
+    where, sep, func = str(position).partition(':')
+    func = func.strip()
+    if not sep or where.strip() not in ANCHORED_POSITIONS or not func or is_glob(func):
+        return None
+    return where.strip(), func
+
+# (start, end) of the inside of a captured function's braces, from its own span (no file-wide search).
+# start is the line after the '{', end the start of the line holding the closing '}'.
+def function_body_bounds(func_text: str, name: str) -> Optional[Tuple[int, int]]:
+    spans = (build_function_index(func_text) or {}).get(name)
+    if spans:
+        _, open_at, close = spans[0][0], spans[0][1], spans[0][2] - 1
+    else:
+        open_at, close = func_text.find('{'), func_text.rfind('}')
+        if open_at < 0 or close <= open_at:
+            return None
+    nl = func_text.find('\n', open_at, close)
+    start = open_at + 1 if nl < 0 else nl + 1
+    line_start = func_text.rfind('\n', start, close) + 1
+    end = line_start if line_start >= start and not func_text[line_start:close].strip() else close
+    return start, max(start, end)
+
+# Add one function-anchored FILE_ADDITIONS entry to a captured function -> (new text, action)
+def add_function_addition(func_text: str, name: str, rel: str, where: str, addition: str, mod: str, add_id: str) -> Tuple[str, str]:
+    if where in ("before", "after"):
+        seg = PieceTable(func_text)
+        action = add_file_addition(seg, rel, 'start' if where == "before" else 'end', addition, mod, add_id)
+        return seg.text(), action
+    bounds = function_body_bounds(func_text, name)
+    if bounds is None:
+        return func_text, "missing"
+    start, end = bounds
+    seg = PieceTable(func_text[start:end])
+    action = add_file_addition(seg, rel, 'start' if where == "start" else 'end', addition, mod, add_id)
+    inner = seg.text()
+    if action == "add" and where == "start" and func_text[start - 1] != '\n':
+        inner = '\n' + inner  # one-line function: open the body first
+    return func_text[:start] + inner + func_text[end:], action
+
+
+# =====================================
+#          INI KEY-LEVEL RULES
+# =====================================
+
+# INI_REPLACEMENTS = {"Resource/ini/x.ini": {"section": {"key": op}}}, op is one of
+#   "value" (or a number)   set the key (first occurrence; added to the section when missing)
+#   None / ("delete",)      remove every occurrence of the key
+#   ("append", "value")     add another `key = value` line after the existing ones
+# {"section": None} removes a whole section; "" is the part before the first [section].
+# Sections and keys match case-insensitively. Operations of all mods run in priority order.
+INI_OPS = ("set", "delete", "append")
+
+# Flatten one file's INI_REPLACEMENTS into [(section, key or None, op, value)]
+def ini_operations(spec: Any, mod_name: str, rel: str) -> List[Tuple[str, Optional[str], str, Optional[str]]]:
+    out: List[Tuple[str, Optional[str], str, Optional[str]]] = []
+    if not isinstance(spec, dict):
+        log(f"[WARN] INI_REPLACEMENTS [{mod_name}] {rel}: expected {{section: {{key: value}}}}, ignored")
+        return out
+    for section, keys in spec.items():
+        if keys is None:
+            out.append((str(section), None, "delete", None))
+            continue
+        if not isinstance(keys, dict):
+            log(f"[WARN] INI_REPLACEMENTS [{mod_name}] {rel} [{section}]: expected {{key: value}}, ignored")
+            continue
+        for key, op in keys.items():
+            if op is None:
+                out.append((str(section), str(key), "delete", None))
+            elif isinstance(op, (str, int, float)):
+                out.append((str(section), str(key), "set", str(op)))
+            elif isinstance(op, (list, tuple)) and op and op[0] in INI_OPS and (op[0] == "delete" or len(op) == 2):
+                out.append((str(section), str(key), op[0], None if op[0] == "delete" else str(op[1])))
+            else:
+                log(f"[WARN] INI_REPLACEMENTS [{mod_name}] {rel} [{section}] {key}: unknown operation {op!r}, ignored")
+    return out
+
+def ini_op_text(section: str, key: Optional[str], op: str, value: Optional[str]) -> str:
+    if key is None:
+        return f"[{section}] (whole section) delete"
+    return f"[{section}] {key}" + (f" {op}" if value is None else f" {'+' if op == 'append' else ''}= {value[:40]}")
+
+_INI_KEY_LINE = re.compile(r'^(\s*)([^=;\[\s][^=]*?)(\s*=\s*)([^;\r\n]*?)(\s*;[^\r\n]*)?(\r?\n)?\Z')
+
+# A key=value file parsed once into sections; every rule is a dict lookup plus a list edit,
+# comments, blank lines and the order of untouched lines are kept as they were.
+class IniDocument:
+    def __init__(self, text: str) -> None:
+        self.newline = "\r\n" if "\r\n" in text else "\n"
+        self.final_newline = text.endswith(("\n", "\r"))
+        self.sections: List[List[Any]] = [["", None, []]]  # [name lower, header line, [[key lower or None, line]]]
+        self.by_name: Dict[str, List[List[Any]]] = {"": [self.sections[0]]}
+        for line in text.splitlines(keepends=True):
+            if not line.endswith(("\n", "\r")):
+                line += self.newline
+            stripped = line.strip()
+            if stripped.startswith('[') and ']' in stripped:
+                sec = [stripped[1:stripped.index(']')].strip().lower(), line, []]
+                self.sections.append(sec)
+                self.by_name.setdefault(sec[0], []).append(sec)
+                continue
+            m = _INI_KEY_LINE.match(line)
+            self.sections[-1][2].append([m.group(2).lower() if m else None, line])
+
+    def _section(self, name: str, create: bool) -> Optional[List[Any]]:
+        found = self.by_name.get(name.lower())
+        if found:
+            return found[0]
+        if not create:
+            return None
+        last = self.sections[-1]
+        if last[2] and last[2][-1][1].strip():
+            last[2].append([None, self.newline])  # blank line before the new section
+        sec = [name.lower(), f"[{name}]{self.newline}", []]
+        self.sections.append(sec)
+        self.by_name[sec[0]] = [sec]
+        return sec
+
+    # Position after the last line of this key, else after the last non-blank line of the section
+    @staticmethod
+    def _insert_at(entries: List[List[Any]], key: str) -> int:
+        same = [i for i, e in enumerate(entries) if e[0] == key]
+        if same:
+            return same[-1] + 1
+        keyed = [i for i, e in enumerate(entries) if e[0] is not None] or [i for i, e in enumerate(entries) if e[1].strip()]
+        return keyed[-1] + 1 if keyed else 0
+
+    def _new_line(self, entries: List[List[Any]], key: str, value: str) -> str:
+        for k, line in entries:
+            if k is not None:
+                m = _INI_KEY_LINE.match(line)
+                return f"{m.group(1)}{key}{m.group(3)}{value}{self.newline}"
+        return f"{key} = {value}{self.newline}"
+
+    # Apply one operation -> True if the file changed, False if already so, None if nothing matched
+    def apply(self, section: str, key: Optional[str], op: str, value: Optional[str]) -> Optional[bool]:
+        if key is None:
+            secs = self.by_name.pop(section.lower(), []) if section else []
+            if not secs:
+                return None
+            self.sections = [sec for sec in self.sections if all(sec is not d for d in secs)]
+            return True
+        lkey = key.lower()
+        if op == "delete":
+            hit = False
+            for sec in self.by_name.get(section.lower(), []):
+                kept = [e for e in sec[2] if e[0] != lkey]
+                hit = hit or len(kept) != len(sec[2])
+                sec[2][:] = kept
+            return True if hit else None
+        sec = self._section(section, create=True)
+        entries = sec[2]
+        if op == "set":
+            for e in entries:
+                if e[0] == lkey:
+                    m = _INI_KEY_LINE.match(e[1])
+                    if m.group(4) == value:
+                        return False
+                    e[1] = f"{m.group(1)}{m.group(2)}{m.group(3)}{value}{m.group(5) or ''}{m.group(6) or self.newline}"
+                    return True
+        entries.insert(self._insert_at(entries, lkey), [lkey, self._new_line(entries, key, value or "")])
+        return True
+
+    def text(self) -> str:
+        parts: List[str] = []
+        for _, header, entries in self.sections:
+            if header is not None:
+                parts.append(header)
+            parts.extend(line for _, line in entries)
+        out = "".join(parts)
+        if not self.final_newline and out.endswith(self.newline):
+            out = out[:-len(self.newline)]
+        return out
+
+
+# =====================================
+#          UNIFIED-DIFF PATCHES
+# =====================================
+
+# FILE_PATCHES = {"Program/x.c": "x.patch"} (or a list): unified diffs against the vanilla file, resolved
+# like FILE_REPLACEMENTS. A diff holding several files contributes the section whose path ends with the
+# target. Hunks are looked up through a line -> positions index, first inside the function the hunk
+# belongs to (its @@ heading, else the function at the expected line), then in the whole file.
+class Hunk:
+    def __init__(self, old_start: int, heading: str) -> None:
+        self.old_start = old_start  # 1-based line in the file the diff was made from
+        self.heading = heading      # text after the second @@ (diff -p: the enclosing function)
+        self.lines: List[Tuple[str, str]] = []  # (' ' | '-' | '+', line without its end of line)
+
+_HUNK_HEAD = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@ ?(.*)$')
+
+def _diff_path(line: str) -> str:
+    path = line[4:].split('\t')[0].strip().strip('"')
+    path = norm_relpath(path)
+    return path[2:] if path[:2] in ("a/", "b/") else path
+
+# Same game file? Paths compare case-insensitively and only on whole path components
+def _same_diff_path(a: str, b: str) -> bool:
+    a, b = a.lower(), b.lower()
+    return a == b or a.endswith('/' + b) or b.endswith('/' + a)
+
+# Hunks of `rel` in a unified diff (None if the text holds no usable hunk for it) and the path the
+# diff gives them. A single-file diff is used whatever path it names; the caller warns on a mismatch.
+def parse_unified_diff(text: str, rel: str) -> Tuple[Optional[List[Hunk]], str]:
+    sections: List[Tuple[str, List[Hunk]]] = []
+    lines = text.splitlines()
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        i += 1
+        if line.startswith('+++ '):
+            sections.append((_diff_path(line), []))
+            continue
+        m = _HUNK_HEAD.match(line)
+        if m is None:
+            continue
+        if not sections:
+            sections.append(("", []))
+        hunk = Hunk(int(m.group(1)), m.group(5).strip())
+        old_left = int(m.group(2) or 1)
+        new_left = int(m.group(4) or 1)
+        while i < len(lines) and (old_left > 0 or new_left > 0):
+            body = lines[i]
+            i += 1
+            kind, rest = (body[:1] or ' '), body[1:]
+            if kind == '\\':
+                continue  # "\ No newline at end of file"
+            if kind not in ' -+':
+                return None, ""
+            hunk.lines.append((kind, rest))
+            if kind != '+':
+                old_left -= 1
+            if kind != '-':
+                new_left -= 1
+        sections[-1][1].append(hunk)
+    if len(sections) == 1:
+        return sections[0][1] or None, sections[0][0]
+    for path, hunks in sections:
+        if hunks and _same_diff_path(path, rel):
+            return hunks, path
+    return None, ""
+
+# FILE_PATCHES spec written as the diff itself rather than a .patch/.diff file name
+def _is_inline_diff(spec: Any) -> bool:
+    return isinstance(spec, str) and ("\n" in spec and (spec.startswith(("---", "@@")) or "\n@@ " in spec))
+
+# Hunk lines to look for with `cut` context lines dropped at each end (never changed lines)
+def _fuzzed(hunk: Hunk, cut: int) -> Tuple[int, List[Tuple[str, str]]]:
+    lines = hunk.lines
+    lead = next((k for k, (kind, _) in enumerate(lines) if kind != ' '), len(lines))
+    trail = next((k for k, (kind, _) in enumerate(reversed(lines)) if kind != ' '), len(lines))
+    a, b = min(cut, lead), min(cut, trail)
+    return a, lines[a:len(lines) - b]
+
+# Apply one unified diff to text -> (new text, events, applied hunks, failed hunks)
+def apply_unified_diff(text: str, hunks: List[Hunk], rel: str, fuzz: int,
+                       index: Optional[Dict[str, List[Tuple[int, int, int]]]]) -> Tuple[str, List[str], int, int]:
+    src = text.splitlines(keepends=True)
+    keys = [ln.rstrip('\r\n') for ln in src]
+    where: Dict[str, List[int]] = defaultdict(list)
+    for n, k in enumerate(keys):
+        where[k].append(n)
+    newline = "\r\n" if "\r\n" in text else "\n"
+
+    # Function spans as line ranges
+    starts = [0]
+    for ln in src:
+        starts.append(starts[-1] + len(ln))
+    spans: List[Tuple[int, int, str]] = []
+    for name, found in (index or {}).items():
+        for header, _, end in found:
+            spans.append((bisect.bisect_right(starts, header) - 1, bisect.bisect_left(starts, end), name))
+
+    def scope(hunk: Hunk, expected: int) -> Optional[Tuple[int, int]]:
+        m = _HEADER_NAME.search(hunk.heading.split('(')[0]) if '(' in hunk.heading else None
+        named = [(a, b) for a, b, name in spans if m is not None and name == m.group(1)]
+        around = [(a, b) for a, b, _ in spans if a <= expected < b]
+        pool = named or around
+        return min(pool, key=lambda ab: abs(ab[0] - expected)) if pool else None
+
+    def find(block: List[str], expected: int, lo: int, window: Optional[Tuple[int, int]]) -> Optional[int]:
+        if not block:
+            return max(lo, min(expected, len(src)))
+        cands = [p for p in where.get(block[0], ()) if p >= lo and p + len(block) <= len(src)]
+        for bounds in ((window,) if window else ()) + (None,):
+            pool = [p for p in cands if bounds is None or bounds[0] <= p and p + len(block) <= bounds[1]]
+            for p in sorted(pool, key=lambda p: abs(p - expected)):
+                if keys[p:p + len(block)] == block:
+                    return p
+        return None
+
+    placed: List[Tuple[int, List[Tuple[str, str]]]] = []
+    events: List[str] = []
+    lo = 0
+    offset = 0
+    failed = 0
+    for n, hunk in enumerate(hunks, 1):
+        expected = max(0, hunk.old_start - 1 + offset)
+        window = scope(hunk, expected)
+        pos = None
+        already = False
+        for cut in range(0, max(0, fuzz) + 1):
+            skip, lines = _fuzzed(hunk, cut)
+            pos = find([t for kind, t in lines if kind != '+'], expected + skip, lo, window)
+            if pos is not None:
+                break
+            if any(kind != ' ' for kind, _ in hunk.lines):
+                # the result is there already (at the same fuzz): don't go looking for a fuzzier spot
+                done = find([t for kind, t in lines if kind != '-'], expected + skip, lo, window)
+                if done is not None:
+                    offset = done - skip - (hunk.old_start - 1)
+                    lo = done + sum(1 for kind, _ in lines if kind != '-')
+                    events.append(f"\t > [PATCH SKIP] {rel} hunk #{n} -> already applied")
+                    already = True
+                    break
+        if pos is None:
+            if not already:
+                failed += 1
+                events.append(f"\t > [PATCH FAILED] {rel} hunk #{n} at line {hunk.old_start} -> context not found")
+            continue
+        start = pos - skip
+        offset = start - (hunk.old_start - 1)
+        note = []
+        if offset:
+            note.append(f"offset {offset:+d} line(s)")
+        if cut:
+            note.append(f"fuzz {cut}")
+        events.append(f"\t > [PATCH HUNK] {rel} hunk #{n} at line {start + 1}" + (f" ({', '.join(note)})" if note else ""))
+        placed.append((pos, lines))
+        lo = pos + sum(1 for kind, _ in lines if kind != '+')
+
+    out: List[str] = []
+    cur = 0
+    for pos, lines in placed:
+        out.extend(src[cur:pos])
+        cur = pos
+        for kind, t in lines:
+            if kind == ' ':
+                out.append(src[cur])
+                cur += 1
+            elif kind == '-':
+                cur += 1
+            else:
+                if out and not out[-1].endswith(('\n', '\r')):
+                    out[-1] += newline
+                out.append(t + newline)
+    out.extend(src[cur:])
+    return "".join(out), events, len(placed), failed
+
+
+# =====================================
+#            FILE PATCHING
+# =====================================
+
+# Rules for one target file with every spec already resolved to text.
+# Plain data only, so it can be pickled and sent to worker processes.
+class FileRules:
+    def __init__(self, rel: str) -> None:
+        self.rel = rel
+        self.func_lines: Dict[str, List[Tuple[str, str, str, str]]] = {}  # func -> [(old text, new text, new spec, mod)]
+        self.func_full: Dict[str, Tuple[str, str, str]] = {}             # func -> (new text, spec, mod)
+        self.file_lines: List[Tuple[str, str, str, str]] = []            # [(old text, new text, new spec, mod)]
+        self.file_adds: List[Tuple[str, str, str, str]] = []             # [(position, text, spec, mod)]
+        self.file_replace: Optional[Tuple[str, str, str]] = None         # (new text, spec, mod)
+        self.file_copy: Optional[Tuple[str, str, str]] = None            # binary FILE_REPLACEMENTS: (replacement path, spec, mod)
+        self.ini_ops: List[Tuple[str, Optional[str], str, Optional[str], str]] = []  # [(section, key, op, value, mod)]
+        self.patches: List[Tuple[str, str, str, int]] = []  # [(diff text, spec, mod, fuzz)]
+        self.anchors: Dict[str, Tuple[str, ...]] = {}                    # old text -> literal_anchors()
+        self.rules_hash = ""   # rule specs as written in replacements.py
+        self.assets_hash = ""  # resolved texts of the referenced line/function/file assets
+        self._wildcards: Optional[List[Tuple[str, re.Pattern]]] = None
+
+    @property
+    def func_names(self) -> List[str]:
+        return list(self.func_lines.keys()) + list(self.func_full) + list(self.anchored_adds())
+
+    # FILE_ADDITIONS anchored to a function: func -> [(file_adds index, where, add id)]
+    def anchored_adds(self) -> Dict[str, List[Tuple[int, str, str]]]:
+        out: Dict[str, List[Tuple[int, str, str]]] = {}
+        ordinals: Dict[Tuple[str, str], int] = {}
+        for i, (position, _, _, mod) in enumerate(self.file_adds):
+            anchor = parse_anchored_position(position)
+            if anchor is not None:
+                tag = f"{anchor[0]}:{anchor[1]}"
+                n = ordinals[(mod, tag)] = ordinals.get((mod, tag), -1) + 1
+                out.setdefault(anchor[1], []).append((i, anchor[0], f"{tag}#{n}"))
+        return out
+
+    # LINE_REPLACEMENTS wildcard function names that match `func`, in rule order
+    def func_wildcards(self, func: str) -> List[str]:
+        if self._wildcards is None:
+            self._wildcards = [(k, glob_regex(k)) for k in self.func_lines if is_glob(k)]
+        return [k for k, rx in self._wildcards if k != func and rx.match(func)]
+
+    # One entry per rule, ids match FileResult.rule_hits keys
+    def describe(self) -> List[Dict[str, Any]]:
+        out: List[Dict[str, Any]] = []
+        for func, entries in self.func_lines.items():
+            for i, (_, _, spec, mod) in enumerate(entries):
+                out.append({"id": f"line:{func}:{i}", "kind": "LINE_REPLACEMENTS", "mod": mod, "function": func, "spec": spec})
+        for func, (_, spec, mod) in self.func_full.items():
+            out.append({"id": f"func:{func}", "kind": "FUNCTION_REPLACEMENTS", "mod": mod, "function": func, "spec": spec})
+        for i, (_, _, spec, mod) in enumerate(self.file_lines):
+            out.append({"id": f"file_line:{i}", "kind": "FILE_LINE_REPLACEMENTS", "mod": mod, "function": None, "spec": spec})
+        for i, (position, _, spec, mod) in enumerate(self.file_adds):
+            out.append({"id": f"add:{i}", "kind": "FILE_ADDITIONS", "mod": mod, "function": None, "spec": spec, "position": position})
+        if self.file_replace is not None:
+            out.append({"id": "file", "kind": "FILE_REPLACEMENTS", "mod": self.file_replace[2], "function": None, "spec": self.file_replace[1]})
+        if self.file_copy is not None:
+            out.append({"id": "file", "kind": "FILE_REPLACEMENTS", "mod": self.file_copy[2], "function": None, "spec": self.file_copy[1]})
+        for i, (_, spec, mod, _) in enumerate(self.patches):
+            out.append({"id": f"patch:{i}", "kind": "FILE_PATCHES", "mod": mod, "function": None, "spec": spec})
+        for i, (section, key, op, value, mod) in enumerate(self.ini_ops):
+            out.append({"id": f"ini:{i}", "kind": "INI_REPLACEMENTS", "mod": mod, "function": None,
+                        "spec": ini_op_text(section, key, op, value)})
+        return out
+
+# Outcome of patching one file in one target; log lines are emitted by the caller, in job order.
+class FileResult:
+    def __init__(self, rel: str, label: str) -> None:
+        self.rel = rel
+        self.label = label
+        self.log_lines: List[str] = []
+        self.stats: Dict[str, int] = {}  # function (or '<file>') -> replaced count
+        self.func_swaps = 0
+        self.file_swaps = 0
+        self.ledger: Optional[dict] = None  # fingerprint entry for the next run
+        self.rule_hits: Dict[str, int] = {}  # FileRules.describe() id -> matches
+        self.plan: Optional[dict] = None  # plan mode: action + staged/diff paths
+        self.staged: Optional[Tuple[Path, Path]] = None  # (temp file, target) waiting for commit_staged_writes()
+        self.failed = False  # output could not be staged -> the run must not commit
+        self.new_patterns: Dict[str, Tuple[str, int]] = {}  # pattern sources built by this job
+        self.pending_write = None  # pipeline: Future of the writer stage, result is final once it is done
+        self.backup_created: Optional[Path] = None  # for the run journal
+
+    def count(self, func: str, n: int) -> None:
+        self.stats[func] = self.stats.get(func, 0) + n
+
+    def hit(self, rule_id: str, n: int) -> None:
+        self.rule_hits[rule_id] = self.rule_hits.get(rule_id, 0) + n
+
+
+# Per-run settings handed to every patch job (module flags do not reach worker processes)
+class RunOptions:
+    def __init__(self, backup_dir: Path, plan_dir: Optional[Path] = None, fsync_policy: str = "batch",
+                 engine: str = "regex", slow_rule_secs: float = 0.0) -> None:
+        self.backup_dir = backup_dir
+        self.engine = engine  # MATCH_ENGINE
+        self.slow_rule_secs = slow_rule_secs  # SLOW_RULE_SECONDS, 0 = no slow-rule report
+        self.plan_dir = plan_dir  # set -> dry run: outputs + diffs go here, game files and backups stay untouched
+        self.fsync_policy = fsync_policy
+
+
+def _spec_text(spec: Any, loader) -> str:
+    return loader(spec) if isinstance(spec, str) else str(spec)
+
+def build_file_rules(merged: ReplBundle, rel: str) -> FileRules:
+    rules = FileRules(rel)
+    for func, pairs in merged.line_replacements.get(rel, {}).items():
+        rules.func_lines[func] = [
+            (_spec_text(old, resolve_line_spec_to_text), _spec_text(new_spec, load_line_replacement), str(new_spec),
+             merged.origin_of(("line", rel, func), i))
+            for i, (old, new_spec) in enumerate(pairs)
+        ]
+    for func, spec in merged.function_replacements.get(rel, {}).items():
+        rules.func_full[func] = (_spec_text(spec, load_function_replacement), str(spec), merged.origin_of(("func", rel, func)))
+    for i, (old, new_spec) in enumerate(merged.file_line_replacements.get(rel, [])):
+        rules.file_lines.append((_spec_text(old, resolve_line_spec_to_text), _spec_text(new_spec, load_line_replacement), str(new_spec),
+                                 merged.origin_of(("file_line", rel), i)))
+    for i, (position, spec) in enumerate(merged.file_additions.get(rel, [])):
+        rules.file_adds.append((position, _spec_text(spec, load_line_replacement), str(spec), merged.origin_of(("add", rel), i)))
+    spec_file = merged.file_replacements.get(rel)
+    copy_path = resolve_binary_replacement(rel, spec_file) if isinstance(spec_file, str) else None
+    if copy_path is not None:
+        rules.file_copy = (str(copy_path), spec_file, merged.origin_of(("file", rel)))
+    elif spec_file is not None:
+        rules.file_replace = (_spec_text(spec_file, load_file_replacement), str(spec_file), merged.origin_of(("file", rel)))
+    for i, (section, key, op, value) in enumerate(merged.ini_replacements.get(rel, [])):
+        rules.ini_ops.append((section, key, op, value, merged.origin_of(("ini", rel), i)))
+    for i, spec in enumerate(merged.file_patches.get(rel, [])):
+        mod = merged.origin_of(("patch", rel), i)
+        if not _is_inline_diff(spec) and not (isinstance(spec, str) and _resolve_in(list(reversed(FILES_SEARCH)), spec).is_file()):
+            log(f"[WARN] FILE_PATCHES [{mod}] {rel}: patch file `{str(spec)[:60]}` not found, ignored")
+            continue
+        rules.patches.append((_spec_text(spec, load_file_replacement), str(spec), mod, PATCH_FUZZ))
+    for old_text, *_ in [e for entries in rules.func_lines.values() for e in entries] + rules.file_lines:
+        rules.anchors[old_text] = literal_anchors(old_text)
+
+    specs = [LEDGER_VERSION, merged.line_replacements.get(rel), merged.function_replacements.get(rel),
+             merged.file_line_replacements.get(rel), merged.file_additions.get(rel), spec_file]
+    if rel in merged.ini_replacements:
+        specs.append(merged.ini_replacements[rel])  # only when used, so existing ledger entries stay valid
+    if rel in merged.file_patches:
+        specs.append(("patch", merged.file_patches[rel], PATCH_FUZZ))
+    texts = [rules.func_lines, rules.func_full, rules.file_lines, rules.file_adds, rules.file_replace, rules.ini_ops, rules.patches]
+    if copy_path is not None:
+        texts.append((rules.file_copy, _stat_key(copy_path)))  # by stat: binary assets are not read to plan the run
+    rules.rules_hash = file_digest(repr(specs).encode("utf-8", errors="replace"))
+    rules.assets_hash = file_digest(repr(texts).encode("utf-8", errors="replace"))
+    return rules
+
+
+# Patch one file of one target (backup, source read, function/file rules, write).
+# Result of running one file's rules over one source text (shared by targets with identical sources)
+class PatchedSource:
+    def __init__(self) -> None:
+        self.new_content = ""
+        self.new_raw: Optional[bytes] = None  # None -> encode_error says why
+        self.encode_error = ""
+        self.encoding = ""  # detected source encoding, also used for the output
+        self.events: List[str] = []
+        self.warnings: List[str] = []  # logged even when nothing is written
+        self.stats: Dict[str, int] = {}
+        self.rule_hits: Dict[str, int] = {}
+        self.func_swaps = 0
+        self.file_swaps = 0
+
+        self._digest: Optional[str] = None
+
+    def count(self, func: str, n: int) -> None:
+        self.stats[func] = self.stats.get(func, 0) + n
+
+    def hit(self, rule_id: str, n: int) -> None:
+        self.rule_hits[rule_id] = self.rule_hits.get(rule_id, 0) + n
+
+    def digest(self) -> str:
+        if self._digest is None:
+            self._digest = file_digest(self.new_raw or b"")
+        return self._digest
+
+_PATCH_MEMO: Dict[Tuple[str, str, str, str], PatchedSource] = {}
+_PATCH_MEMO_REL: Optional[str] = None  # jobs come sorted by rel, so only the current file's sources are kept
+
+# Apply all rules of a file to its source bytes. index_hash: content hash for the on-disk function index cache.
+def transform_source(rules: FileRules, source_raw: bytes, index_hash: Optional[str], engine: str,
+                     encoding_hint: Optional[str] = None, slow_rule_secs: float = 0.0) -> PatchedSource:
+    rel = rules.rel
+    res = PatchedSource()
+    header_matcher = FunctionHeaderMatcher(rules.func_names)
+    source_text, source_enc = decode_best_effort(source_raw, encoding_hint)
+    res.encoding = source_enc
+
+    pending_events: List[str] = []
+    doc = PieceTable()
+    anchored = rules.anchored_adds()
+
+    # ---------- unified diffs (made against vanilla, so they go first) ----------
+    if rules.patches:
+        index = load_function_index(index_hash, source_text) if index_hash is not None else build_function_index(source_text)
+        text = source_text
+        for i, (diff_text, spec, mod, fuzz) in enumerate(rules.patches):
+            hunks, named = parse_unified_diff(diff_text, rel)
+            if hunks is not None and named and not _same_diff_path(named, rel):
+                res.warnings.append(f"\t     [WARN] Patch is for `{named}`, applied to this file: [{mod}] {rel} `{spec[:60]}`")
+            if hunks is None:
+                pending_events.append(f"\t > [PATCH FAILED] {rel} -> `{spec[:60]}` has no hunks for this file")
+                res.warnings.append(f"\t     [WARN] Patch has no hunks for this file: [{mod}] {rel} `{spec[:60]}`")
+                continue
+            if text is not source_text:
+                index = build_function_index(text)
+            text, events, applied, failed = apply_unified_diff(text, hunks, rel, fuzz, index)
+            pending_events.extend(events)
+            if failed:
+                res.warnings.append(f"\t     [WARN] {failed} of {len(hunks)} hunk(s) failed: [{mod}] {rel} `{spec[:60]}`")
+            if applied:
+                res.hit(f"patch:{i}", applied)
+                res.count('<file>', applied)
+        if text != source_text:
+            source_text, index_hash = text, None  # function index of the patched text is built below
+
+    # ---------- function-scope processing ----------
+    chunks: Iterator[Tuple[Optional[str], int, int]]
+    if rules.func_names:
+        if index_hash is not None:
+            index = load_function_index(index_hash, source_text)
+        else:
+            index = build_function_index(source_text)
+        if index is not None:
+            names = header_matcher.names | {n for n in index if header_matcher.patterns and header_matcher.wanted(n)}
+            chunks = iter_function_chunks_indexed(source_text, index, names)
+        else:
+            chunks = chunk_offsets(iter_function_chunks_by_lines(source_text, header_matcher))
+    else:
+        chunks = iter([(None, 0, len(source_text))])
+
+    for in_function, chunk_start, chunk_end in chunks:
+        if in_function is None:
+            doc.append(source_text, chunk_start, chunk_end)
+            continue
+        func_text = source_text[chunk_start:chunk_end]
+
+        # Decide output: full-function swap (preferred) or modified original
+        if in_function in rules.func_full:
+            out_text, spec, _ = rules.func_full[in_function]
+            res.func_swaps += 1
+            res.hit(f"func:{in_function}", 1)
+            pending_events.append(f"\t > [REPLACE FUNCTION]  {in_function}\t\t`{spec[:50]}`")
+        else:
+            # Apply line/block replacements (multiline-aware): the function's own, then wildcard ones
+            scoped = [(key, i, e) for key in (in_function, *rules.func_wildcards(in_function))
+                      for i, e in enumerate(rules.func_lines.get(key, []))]
+            entries = [e for _, _, e in scoped]
+            watch = RuleWatch(slow_rule_secs)
+            func_text, hits = apply_rules(func_text, [(old, new) for old, new, _, _ in entries], 1, engine, rules.anchors, watch)
+            _report_watch(res, watch, entries, f"function {in_function}")
+            for (key, i, (_, _, new_spec, _)), n in zip(scoped, hits):
+                if n > 0:
+                    res.count(in_function, n)
+                    res.hit(f"line:{key}:{i}", n)
+                    new_spec_log = ' '.join(new_spec.split())
+                    pending_events.append(f"\t > [REPLACE LINE]      {in_function}\t\t`{new_spec_log[:50]}`")
+
+            out_text = func_text
+
+        # Function-anchored additions, placed from this function's span (first definition only)
+        for i, where, add_id in anchored.pop(in_function, ()):
+            _, addition, spec, mod = rules.file_adds[i]
+            if not addition:
+                continue
+            out_text, action = add_function_addition(out_text, in_function, rel, where, addition, mod, add_id)
+            if action in ("skip", "missing"):
+                reason = "already present" if action == "skip" else "function body not found"
+                pending_events.append(f"\t > [ADD SKIP] {rel} {where}:{in_function} -> `{spec[:60]}` {reason}")
+                continue
+            res.hit(f"add:{i}", 1)
+            pending_events.append(f"\t > [ADD {where.upper()}{' UPDATE' if action == 'update' else ''}] {rel} {in_function}() -> `{spec[:60]}`")
+
+        # Emit processed function ONCE
+        doc.append(out_text)
+
+    for func, entries in anchored.items():
+        for i, where, _ in entries:
+            pending_events.append(f"\t > [ADD SKIP] {rel} {where}:{func} -> `{rules.file_adds[i][2][:60]}` function not found")
+
+    # ---------- file-level replacements & additions ----------
+    # the full text is only built when some rule's anchors are all in the document
+    if rules.file_lines and any(all(a in doc for a in rules.anchors.get(old, ())) for old, *_ in rules.file_lines):
+        watch = RuleWatch(slow_rule_secs)
+        text, hits = apply_rules(doc.text(), [(old, new) for old, new, _, _ in rules.file_lines], 0, engine, rules.anchors, watch)
+        _report_watch(res, watch, rules.file_lines, "file scope")
+        if any(hits):
+            doc = PieceTable(text)
+    else:
+        hits = []
+    for i, ((_, _, new_spec, _), n) in enumerate(zip(rules.file_lines, hits)):
+        if n > 0:
+            pending_events.append(f"\t > [REPLACE FILE-LINE] {rel} -> `{new_spec[:60]}`")
+            res.count('<file>', n)
+            res.hit(f"file_line:{i}", n)
+
+    if rules.ini_ops:
+        ini = IniDocument(doc.text())
+        changed = False
+        for i, (section, key, op, value, _) in enumerate(rules.ini_ops):
+            outcome = ini.apply(section, key, op, value)
+            what = ini_op_text(section, key, op, value)
+            if outcome is None:
+                pending_events.append(f"\t > [INI SKIP] {rel} {what} -> not found")
+                continue
+            res.hit(f"ini:{i}", 1)
+            if outcome:
+                changed = True
+                res.count('<file>', 1)
+                pending_events.append(f"\t > [INI {op.upper()}] {rel} {what}")
+        if changed:
+            doc = PieceTable(ini.text())
+
+    ordinals: Dict[Tuple[str, str], int] = {}
+    for i, (position, addition, spec, mod) in enumerate(rules.file_adds):
+        if not addition or parse_anchored_position(position) is not None:
+            continue
+        where = 'start' if position == 'start' else 'end'
+        n = ordinals[(mod, where)] = ordinals.get((mod, where), -1) + 1
+        action = add_file_addition(doc, rel, where, addition, mod, f"{where}#{n}")
+        if action == "skip":
+            pending_events.append(f"\t > [ADD SKIP] {rel} {where} -> `{spec[:60]}` already present")
+            continue
+        res.hit(f"add:{i}", 1)
+        if action == "update":
+            pending_events.append(f"\t > [ADD UPDATE] {rel} {where} -> `{spec[:60]}`")
+        elif where == 'start':
+            pending_events.append(f"\t > [ADD START] {rel} -> `{spec[:60]}`")
+        else:
+            pending_events.append(f"\t > [ADD END] {rel} -> `{spec[:60]}`")
+
+    if rules.file_replace is not None:
+        replacement, spec_file, _ = rules.file_replace
+        if len(replacement) != len(doc) or replacement != doc.text():
+            doc = PieceTable(replacement)
+            res.hit("file", 1)
+            pending_events.append(f"\t > [FILE REPLACE] {rel} -> `{spec_file[:60]}`")
+            res.count('<file>', 1)
+            res.file_swaps += 1
+        else:
+            pending_events.append(f"\t > [FILE REPLACE] {rel} -> already up-to-date")
+
+    res.events = pending_events
+    res.new_content = doc.text()
+    try:
+        res.new_raw = encode_output(res.new_content, source_enc)
+    except Exception as e:
+        res.encode_error = str(e)
+    return res
+
+def _report_watch(res: PatchedSource, watch: RuleWatch, entries: list, scope: str) -> None:
+    for k, elapsed in watch.slow:
+        old, mod = entries[k][0], entries[k][3]
+        res.warnings.append(f"\t     [WARN] Slow rule ({elapsed:.1f}s): [{mod}] {scope} `{' '.join(old.split())[:60]}`")
+
+# Reads of one patch job that do not depend on the patch itself, done ahead by the pipeline's
+# prefetch stage. Only files that already have a backup are prefetched; None -> read inline.
+class Prefetched:
+    def __init__(self, exists_now: bool, had_backup: bool) -> None:
+        self.exists_now = exists_now
+        self.had_backup = had_backup
+        self.fingerprint: Optional[dict] = None
+        self.source_raw: Optional[bytes] = None
+        self.up_to_date = False
+        self.live_stat: Optional[List[int]] = None
+
+def prefetch_job(rules: FileRules, label: str, root: Path, opts: RunOptions, prev: Optional[dict] = None) -> Optional[Prefetched]:
+    full_path = root / rules.rel
+    backup_path = opts.backup_dir / label / rules.rel
+    try:
+        pre = Prefetched(full_path.exists(), backup_path.exists())
+        if not pre.had_backup:
+            return pre
+        pre.fingerprint, pre.source_raw = _job_fingerprint(rules, backup_path, prev)
+        if pre.fingerprint is None:
+            return None
+        pre.up_to_date = prev is not None and _is_up_to_date(prev, pre.fingerprint, full_path)
+        if not pre.up_to_date:
+            if pre.source_raw is None and rules.file_copy is None:
+                pre.source_raw = backup_path.read_bytes()
+            pre.live_stat = _stat_key(full_path)
+        return pre
+    except OSError:
+        return None
+
+def patch_target_file(rules: FileRules, label: str, root: Path, opts: RunOptions, prev: Optional[dict] = None,
+                      pre: Optional[Prefetched] = None, writer=None) -> FileResult:
+    rel = rules.rel
+    res = FileResult(rel, label)
+    log = res.log_lines.append
+    target_rel = Path(rel)  # Path to file, example: "Program/interface/seadogs.c"
+    filename_display = f"{rel} ({label})"
+    full_path = root / target_rel
+    if rel == "Program/colonies/Colonies_init.c":
+        log(f"\t     [DEBUG] funcs_lines keys: {list(rules.func_lines.keys())}")
+        log(f"\t     [DEBUG] funcs_full keys: {list(rules.func_full.keys())}")
+
+    # Leave idle files for logging
+    backup_path = opts.backup_dir / label / target_rel
+    if pre is not None:
+        exists_now, had_backup = pre.exists_now, pre.had_backup
+    else:
+        exists_now = full_path.exists()
+        had_backup = backup_path.exists()
+    if not exists_now and not had_backup:
+        return res
+    
+    log(f"==> {filename_display}")
+
+    # Ensure backup exists (create once)
+    try:
+        if exists_now and opts.plan_dir is not None:
+            if not had_backup:
+                log(f"\t     [INFO] (plan) Backup would be created")
+        elif exists_now:
+            if not had_backup:
+                backup_path.parent.mkdir(parents=True, exist_ok=True)
+                try:
+                    if rules.file_copy is not None:
+                        transfer_file(full_path, backup_path)  # a real copy: never shares the live file's inode
+                        shutil.copystat(full_path, backup_path)
+                    else:
+                        shutil.copy2(full_path, backup_path)
+                    res.backup_created = backup_path
+                    log(f"\t     [BACKUP CREATED]")
+                    had_backup = True
+                except Exception as e:
+                    log(f"\t     [ERROR] Could not create backup! {e}")
+        else:                    
+            log(f"\t     [INFO] Target missing, will use existing backup")
+    except Exception as e:
+        log(f"\t     [ERROR] Checking/creating backup {e}")
+        return res
+
+    # Source: always a backup of the original if we have it, otherwise a live file
+    prefetched = pre is not None and pre.fingerprint is not None
+    source_path = backup_path if prefetched or backup_path.exists() else full_path
+    fingerprint: Optional[dict] = None
+    source_raw: Optional[bytes] = None
+    if prefetched:
+        fingerprint, source_raw = pre.fingerprint, pre.source_raw
+    elif source_path == backup_path:
+        fingerprint, source_raw = _job_fingerprint(rules, backup_path, prev)
+
+    # Resumed run: the interrupted run already staged the output for these same inputs
+    if prev is not None and prev.get("resumed"):
+        prev = {k: v for k, v in prev.items() if k != "resumed"}
+        tmp_path = staged_path_for(full_path)
+        if (fingerprint is not None and all(prev.get(k) == fingerprint[k] for k in ("source", "rules", "assets"))
+                and _stat_key(tmp_path) == prev.get("output_stat")):
+            for func, cnt in (prev.get("stats") or {}).items():
+                res.count(func, cnt)
+            res.func_swaps = int(prev.get("func_swaps", 0))
+            res.file_swaps = int(prev.get("file_swaps", 0))
+            res.ledger = prev
+            res.staged = (tmp_path, full_path)
+            log(f"\t     [UPDATE FILE]       (resumed) Staged by the interrupted run")
+            return res
+
+    # Incremental run: inputs unchanged and live file untouched since our last write
+    if pre.up_to_date if prefetched else prev is not None and _is_up_to_date(prev, fingerprint, full_path):
+        for func, cnt in (prev.get("stats") or {}).items():
+            res.count(func, cnt)
+        res.func_swaps = int(prev.get("func_swaps", 0))
+        res.file_swaps = int(prev.get("file_swaps", 0))
+        res.ledger = prev
+        log(f"\t     [NO CHANGE]         Inputs unchanged since last run")
+        return res
+
+    if rules.file_copy is not None:
+        return _copy_target_file(res, rules, full_path, exists_now, fingerprint, prev,
+                                 pre.live_stat if prefetched else None, opts, writer)
+
+    try:
+        if source_raw is None:
+            source_raw = source_path.read_bytes()
+    except FileNotFoundError:
+        log(f"\t|     [WARN] Source file not found, skipping...")
+        return res
+
+    # Targets sharing a source (workshop copies of vanilla scripts) are patched once per run
+    global _PATCH_MEMO_REL
+    content_hash = fingerprint["source"] if fingerprint else file_digest(source_raw)
+    if _PATCH_MEMO_REL != rel:
+        _PATCH_MEMO.clear()
+        _PATCH_MEMO_REL = rel
+    memo_key = (rules.rules_hash, rules.assets_hash, content_hash, opts.engine)
+    patched = _PATCH_MEMO.get(memo_key)
+    if patched is None:
+        patched = _PATCH_MEMO[memo_key] = transform_source(rules, source_raw, content_hash if source_path == backup_path else None,
+                                                           opts.engine, fingerprint.get("encoding") if fingerprint else None,
+                                                           opts.slow_rule_secs)
+    new_content, new_raw, pending_events, encode_error = patched.new_content, patched.new_raw, list(patched.events), patched.encode_error
+    res.stats, res.rule_hits = dict(patched.stats), dict(patched.rule_hits)
+    res.func_swaps, res.file_swaps = patched.func_swaps, patched.file_swaps
+    for ln in patched.warnings:
+        log(ln)
+    if new_raw is None:
+        log(f"\t     [ERROR] Writing updated file {full_path}: {encode_error}")
+        return res
+
+    if opts.plan_dir is not None:
+        return _stage_plan_output(res, opts.plan_dir, full_path, new_content, new_raw, pending_events)
+
+    def _remember(output_stat: Optional[List[int]]) -> None:
+        if fingerprint is None or output_stat is None:
+            return
+        res.ledger = dict(fingerprint, encoding=patched.encoding, output=patched.digest(), output_stat=output_stat, stats=dict(res.stats),
+                          func_swaps=res.func_swaps, file_swaps=res.file_swaps)
+
+    # If nothing changed compared to current live file, skip write.
+    # Decided from stat + hash when the live file is still our last output, else by a plain bytes compare.
+    live_stat = pre.live_stat if prefetched else _stat_key(full_path)
+    if live_stat is None:
+        unchanged = not new_raw
+    elif prev and prev.get("output_stat") == live_stat and prev.get("output"):
+        unchanged = prev["output"] == patched.digest()
+    else:
+        try:
+            unchanged = live_stat[0] == len(new_raw) and full_path.read_bytes() == new_raw
+        except OSError:
+            unchanged = False
+    if unchanged:
+        if pending_events:
+            log(f"\t     [NO CHANGE]         File is already up-to-date")
+        else:
+            log(f"\t     [NO CHANGE]         No write needed")
+        _remember(live_stat)
+        return res
+
+    # Stage new file next to the target; main() swaps all staged files in at the end of the run
+    if writer is not None:
+        res.pending_write = writer.submit(_stage_output, res, full_path, exists_now, new_raw, pending_events, opts, _remember)
+    else:
+        _stage_output(res, full_path, exists_now, new_raw, pending_events, opts, _remember)
+    return res
+
+# Write stage of a patch job: new content to <target>.wml-tmp (inline, or on the pipeline's writer thread).
+# new_raw: the bytes, or the Path of a binary replacement to transfer as is.
+def _stage_output(res: FileResult, full_path: Path, exists_now: bool, new_raw: Any, pending_events: List[str],
+                  opts: RunOptions, remember) -> None:
+    log = res.log_lines.append
+    tmp_path = staged_path_for(full_path)
+    try:
+        full_path.parent.mkdir(parents=True, exist_ok=True)
+        if isinstance(new_raw, Path):
+            transfer_file(new_raw, tmp_path)
+            if opts.fsync_policy == "always":
+                with open(tmp_path, "rb+") as f:
+                    os.fsync(f.fileno())
+        else:
+            with open(tmp_path, "wb") as f:
+                f.write(new_raw)
+                if opts.fsync_policy == "always":
+                    f.flush()
+                    os.fsync(f.fileno())
+        if exists_now:
+            try:
+                shutil.copymode(full_path, tmp_path)
+            except OSError:
+                pass
+        res.staged = (tmp_path, full_path)
+        log(f"\t     [UPDATE FILE]")
+        for ev in pending_events:
+            log("\t\t" + ev)
+        remember(_stat_key(tmp_path))  # os.replace keeps size and mtime
+    except Exception as e:
+        res.failed = True
+        try:
+            tmp_path.unlink(missing_ok=True)
+        except OSError:
+            pass
+        log(f"\t     [ERROR] Writing updated file {full_path}: {e}")
+
+# =====================================
+#       BINARY FILE REPLACEMENTS
+# =====================================
+
+FICLONE = 0x40049409  # Linux ioctl: copy-on-write clone of a whole file (btrfs, xfs, ...)
+
+# Copy src to dst without passing the data through Python: a reflink where the filesystem can clone,
+# else copy_file_range / sendfile inside the kernel, else shutil's chunked copy. Always a separate
+# file (never a hardlink), and dst is unlinked first, so a file hardlinked to it is never written
+# through. -> how it was copied
+def transfer_file(src: Path, dst: Path) -> str:
+    dst.unlink(missing_ok=True)
+    with open(src, "rb", buffering=0) as fin, open(dst, "wb", buffering=0) as fout:
+        try:
+            import fcntl
+            fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+            return "reflink"
+        except (ImportError, OSError):
+            pass
+        size = os.fstat(fin.fileno()).st_size
+        for how in ("copy_file_range", "sendfile"):
+            call = getattr(os, how, None)
+            if call is None:
+                continue
+            done = 0
+            try:
+                while done < size:
+                    if how == "copy_file_range":
+                        n = call(fin.fileno(), fout.fileno(), size - done, done, done)
+                    else:
+                        n = call(fout.fileno(), fin.fileno(), done, size - done)
+                    if n <= 0:
+                        break
+                    done += n
+            except OSError:
+                pass
+            if done == size:
+                return how
+            fout.truncate(0)  # not supported here (other filesystem, Windows...): start over
+        fout.seek(0)
+        shutil.copyfileobj(fin, fout, 1 << 20)
+    return "copy"
+
+# Patch job of a binary FILE_REPLACEMENTS target: the replacement file is transferred as is,
+# nothing is decoded and neither file is held in memory. Other rules for the file can't apply.
+def _copy_target_file(res: FileResult, rules: FileRules, full_path: Path, exists_now: bool, fingerprint: Optional[dict],
+                      prev: Optional[dict], live_stat: Optional[List[int]], opts: RunOptions, writer=None) -> FileResult:
+    log = res.log_lines.append
+    src_path, spec_file, mod = rules.file_copy
+    src = Path(src_path)
+    if rules.func_lines or rules.func_full or rules.file_lines or rules.file_adds or rules.ini_ops or rules.patches:
+        log(f"\t     [WARN] Binary file replacement by [{mod}]: other rules for this file are ignored")
+    try:
+        digest = path_digest(src)
+        size = src.stat().st_size
+    except OSError as e:
+        log(f"\t     [ERROR] Reading replacement {src}: {e}")
+        return res
+
+    pending_events: List[str] = []
+    if fingerprint is not None and fingerprint.get("source") == digest:
+        pending_events.append(f"\t > [FILE REPLACE] {res.rel} -> already up-to-date")
+    else:
+        res.hit("file", 1)
+        res.count('<file>', 1)
+        res.file_swaps = 1
+        pending_events.append(f"\t > [FILE REPLACE] {res.rel} -> `{spec_file[:60]}` (binary, {size} bytes)")
+
+    if live_stat is None:
+        live_stat = _stat_key(full_path)
+    if live_stat is None:
+        unchanged = False
+    elif prev and prev.get("output_stat") == live_stat and prev.get("output"):
+        unchanged = prev["output"] == digest
+    else:
+        try:
+            unchanged = live_stat[0] == size and filecmp.cmp(full_path, src, shallow=False)
+        except OSError:
+            unchanged = False
+
+    if opts.plan_dir is not None:
+        if unchanged:
+            res.plan = {"action": "unchanged"}
+            log(f"\t     [NO CHANGE]         (plan) File is already up-to-date")
+            return res
+        staged = opts.plan_dir / "files" / res.label / res.rel
+        try:
+            staged.parent.mkdir(parents=True, exist_ok=True)
+            transfer_file(src, staged)
+        except OSError as e:
+            log(f"\t     [ERROR] Staging planned output {staged}: {e}")
+            return res
+        res.plan = {"action": "update", "staged": staged.relative_to(opts.plan_dir).as_posix(), "diff": None}
+        log(f"\t     [UPDATE FILE]       (plan) Staged, game file not written (binary, no diff)")
+        for ev in pending_events:
+            log("\t\t" + ev)
+        return res
+
+    def _remember(output_stat: Optional[List[int]]) -> None:
+        if fingerprint is None or output_stat is None:
+            return
+        res.ledger = dict(fingerprint, output=digest, output_stat=output_stat, stats=dict(res.stats),
+                          func_swaps=res.func_swaps, file_swaps=res.file_swaps)
+
+    if unchanged:
+        log(f"\t     [NO CHANGE]         File is already up-to-date")
+        _remember(live_stat)
+        return res
+
+    if writer is not None:
+        res.pending_write = writer.submit(_stage_output, res, full_path, exists_now, src, pending_events, opts, _remember)
+    else:
+        _stage_output(res, full_path, exists_now, src, pending_events, opts, _remember)
+    return res
+
+# =====================================
+#       SELECTIVE RE-RUN INDEX
+# =====================================
+
+# Reverse index of the last committed run: target file -> mods that had rules for it (+ the asset
+# names those rules mention), and per mod a signature of everything the run read from it. With
+# SELECTIVE_RUN, only files of mods whose signature changed are re-applied; the rest is trusted
+# through the ledger (live file still has the recorded output stat).
+FILE_INDEX_PATH = STATE_PATH.parent / ".wml_file_index.json"
+FILE_INDEX_VERSION = 1
+
+# (signature, asset names) of a mod: enabled variant, priority, replacements.py and asset files by stat
+def mod_signature(mod: Mod) -> Tuple[str, List[str]]:
+    parts: List[Any] = [mod.priority, mod.variant_id, str(mod.replacements_py), _stat_key(mod.replacements_py)]
+    assets: List[str] = []
+    for d in (mod.lines_dir, mod.functions_dir, mod.files_dir):
+        if not d.is_dir():
+            continue
+        for p in sorted(d.rglob("*")):
+            if p.is_file():
+                name = p.relative_to(d).as_posix()
+                assets.append(name)
+                parts.append((d.name, name, _stat_key(p)))
+    return file_digest(repr(parts).encode("utf-8", errors="replace")), sorted(set(assets))
+
+def load_file_index() -> Optional[dict]:
+    try:
+        data = json.loads(FILE_INDEX_PATH.read_text("utf-8"))
+    except Exception:
+        return None
+    if data.get("version") != FILE_INDEX_VERSION or data.get("ledger_version") != LEDGER_VERSION:
+        return None
+    return data
+
+def save_file_index(mod_info: Dict[str, Tuple[str, List[str]]], labels: List[str], files: Dict[str, dict]) -> None:
+    data = {"version": FILE_INDEX_VERSION, "ledger_version": LEDGER_VERSION, "targets": labels,
+            "mods": {name: {"sig": sig, "assets": assets} for name, (sig, assets) in mod_info.items()},
+            "files": files}
+    try:
+        FILE_INDEX_PATH.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+    except Exception:
+        pass
+
+# Short strings inside a rule value: the asset names it may resolve through LINES/FUNCS/FILES_SEARCH
+def _spec_names(v: Any, out: set) -> set:
+    if isinstance(v, str):
+        if "\n" not in v and len(v) <= 200:
+            out.add(v)
+    elif isinstance(v, dict):
+        for vv in v.values():
+            _spec_names(vv, out)
+    elif isinstance(v, (list, tuple)):
+        for vv in v:
+            _spec_names(vv, out)
+    return out
+
+# Index entries for the files of the loaded bundles; `trusted` files keep their entry from `old`
+def file_index_entries(bundles: Dict[str, ReplBundle], old: Optional[dict], trusted: set) -> Dict[str, dict]:
+    files: Dict[str, dict] = {rel: (old or {}).get("files", {})[rel] for rel in trusted}
+    for name, b in bundles.items():
+        for d in b.rule_dicts():
+            for rel, v in d.items():
+                if rel in trusted:
+                    continue
+                entry = files.setdefault(rel, {"mods": [], "specs": []})
+                if name not in entry["mods"]:
+                    entry["mods"].append(name)
+                entry["specs"] = sorted(_spec_names(v, set(entry["specs"])))
+    return files
+
+# (changed mod names, files to re-apply) for a selective run, or None when a full run is needed.
+# Files of changed mods come from the old index here; main() adds the new files of changed mods.
+def select_changed_files(index: dict, mods: List[Mod], mod_info: Dict[str, Tuple[str, List[str]]], labels: List[str],
+                         targets: List[Tuple[str, Path]], ledger: Dict[str, dict]) -> Optional[Tuple[set, set]]:
+    if index.get("targets") != labels or not ledger:
+        return None
+    old_mods = index.get("mods", {})
+    changed = {name for name, (sig, _) in mod_info.items() if old_mods.get(name, {}).get("sig") != sig}
+    gone = set(old_mods) - set(mod_info)
+    # Asset names of changed mods (before and after): rules of other mods may resolve to them
+    names = {a for n in changed | gone for a in old_mods.get(n, {}).get("assets", [])}
+    names |= {a for n in changed for a in mod_info[n][1]}
+    affected = set()
+    for rel, entry in index.get("files", {}).items():
+        if (changed | gone) & set(entry.get("mods", [])) or names & set(entry.get("specs", [])):
+            affected.add(rel)
+            continue
+        # Trusted only while every target still holds the output recorded for it
+        for label, root in targets:
+            prev = ledger.get(f"{label}/{rel}")
+            live = _stat_key(root / rel)
+            if prev is None and live is None:
+                continue
+            if prev is None or live != prev.get("output_stat"):
+                affected.add(rel)
+                break
+    return changed | gone, affected
+
+# =====================================
+#          STAGED COMMIT
+# =====================================
+
+STAGED_SUFFIX = ".wml-tmp"
+
+def staged_path_for(full_path: Path) -> Path:
+    return full_path.with_name(full_path.name + STAGED_SUFFIX)
+
+# Swap every staged file into place. Data is flushed before the first rename (per FSYNC_POLICY),
+# so a crash leaves either the old or the new content of each file, never a torn one.
+# With a journal, each target's current content is kept as <target>.wml-prev and the full list
+# (plus the ledger to save) is journaled before the first rename, so an interrupted commit can be
+# finished or undone on the next start.
+def commit_staged_writes(staged: List[Tuple[Path, Path]], fsync_policy: str, journal: Optional["RunJournal"] = None,
+                         ledger: Optional[Dict[str, dict]] = None) -> int:
+    if journal is not None and staged:
+        files = [[str(tmp), str(dest), journal.keep_previous(dest)] for tmp, dest in staged]
+        journal.record("commit", sync=True, files=files, ledger=ledger or {})
+    if fsync_policy == "batch":
+        for tmp, _ in staged:
+            try:
+                with open(tmp, "rb+") as f:
+                    os.fsync(f.fileno())
+            except OSError as e:
+                log(f"[WARN] Could not flush {tmp}: {e}")
+    done = 0
+    dirs = set()
+    for tmp, dest in staged:
+        try:
+            os.replace(tmp, dest)
+            dirs.add(dest.parent)
+            done += 1
+        except OSError as e:
+            log(f"[ERROR] Could not replace {dest}: {e}")
+            try:
+                tmp.unlink(missing_ok=True)
+            except OSError:
+                pass
+    # Renames themselves are only durable once the directory is flushed (POSIX only)
+    if fsync_policy != "none" and os.name == "posix":
+        for d in dirs:
+            try:
+                fd = os.open(d, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            except OSError:
+                pass
+    return done
+
+def discard_staged_writes(staged: List[Tuple[Path, Path]]) -> None:
+    for tmp, _ in staged:
+        try:
+            tmp.unlink(missing_ok=True)
+        except OSError:
+            pass
+
+# =====================================
+#          RUN JOURNAL
+# =====================================
+
+# Write-ahead journal of the file operations of the current run, one JSON object per line:
+# begin, backup (created), restore (orphan restored), outputs (every <target>.wml-tmp the jobs may
+# stage, before the first is written), staged (output ready), commit (about to swap staged files in). It is deleted when the run ends; one left behind means the run was interrupted,
+# and the next main() resumes or rolls it back (JOURNAL_ACTION).
+JOURNAL_PATH = STATE_PATH.parent / ".wml_journal.jsonl"
+PREV_SUFFIX = ".wml-prev"
+
+def prev_path_for(full_path: Path) -> Path:
+    return full_path.with_name(full_path.name + PREV_SUFFIX)
+
+class RunJournal:
+    def __init__(self, path: Path = JOURNAL_PATH) -> None:
+        self.path = path
+        self.prevs: List[Path] = []  # pre-run contents kept for rollback, dropped by finish()
+        self._f = open(path, "w", encoding="utf-8")
+
+    # sync=True: durable before the caller touches the file the record is about
+    def record(self, op: str, sync: bool = False, **fields: Any) -> None:
+        self._f.write(json.dumps(dict(fields, op=op), ensure_ascii=False) + "\n")
+        self._f.flush()
+        if sync:
+            os.fsync(self._f.fileno())
+
+    # Keep the current content of a game file until the run ends (hardlink where possible, the
+    # file is then replaced by rename, never rewritten in place) -> False when there is none
+    def keep_previous(self, full_path: Path) -> bool:
+        prev = prev_path_for(full_path)
+        prev.unlink(missing_ok=True)
+        try:
+            os.link(full_path, prev)
+        except FileNotFoundError:
+            return False
+        except OSError:
+            shutil.copy2(full_path, prev)
+        self.prevs.append(prev)
+        return True
+
+    # Run over (finished, cancelled or failed without touching game files): drop journal + kept files
+    def finish(self) -> None:
+        self._f.close()
+        for prev in self.prevs:
+            prev.unlink(missing_ok=True)
+        self.path.unlink(missing_ok=True)
+
+# What an interrupted run did, from its journal; None when the last run ended normally
+def read_journal(path: Path = JOURNAL_PATH) -> Optional[dict]:
+    try:
+        lines = path.read_text("utf-8").splitlines()
+    except OSError:
+        return None
+    state: Dict[str, Any] = {"started": "", "backups": [], "restored": [], "outputs": [], "staged": {}, "commit": None}
+    for ln in lines:
+        try:
+            rec = json.loads(ln)
+        except ValueError:
+            continue  # torn last line
+        op = rec.get("op")
+        if op == "begin":
+            state["started"] = rec.get("time", "")
+        elif op == "backup":
+            state["backups"].append(rec["path"])
+        elif op == "restore":
+            state["restored"].append(rec)
+        elif op == "outputs":
+            state["outputs"].extend(rec["tmp"])
+        elif op == "staged":
+            state["staged"][rec["key"]] = rec
+        elif op == "commit":
+            state["commit"] = rec
+    return state
+
+def describe_journal(state: dict) -> str:
+    if state["commit"]:
+        n = len(state["commit"]["files"])
+        return f"started {state['started']}, stopped while writing {n} updated file(s)"
+    return f"started {state['started']}, stopped after preparing {len(state['staged'])} file(s); no game file was updated yet"
+
+# Finish an interrupted run: a commit that was under way is completed (remaining staged files are
+# swapped in, its ledger saved). Outputs staged before that are left for main() to reuse.
+# -> number of files swapped in now
+def resume_journal(state: dict, path: Path = JOURNAL_PATH) -> int:
+    done = 0
+    commit = state["commit"]
+    if commit:
+        for tmp, dest, _ in commit["files"]:
+            tmp, dest = Path(tmp), Path(dest)
+            try:
+                if tmp.exists():
+                    os.replace(tmp, dest)
+                    done += 1
+                prev_path_for(dest).unlink(missing_ok=True)
+            except OSError as e:
+                log(f"[ERROR] Could not replace {dest}: {e}")
+        _save_ledger(commit["ledger"])
+    for rec in state["restored"]:
+        prev_path_for(Path(rec["target"])).unlink(missing_ok=True)
+    for rec in state["staged"].values():
+        prev_path_for(Path(rec["target"])).unlink(missing_ok=True)  # kept for a commit that never started
+    _sweep_outputs(state, keep={rec["tmp"] for rec in state["staged"].values()} if not commit else set())
+    path.unlink(missing_ok=True)
+    return done
+
+# Remove temp outputs the interrupted run may have written without journaling them as staged
+def _sweep_outputs(state: dict, keep: set) -> None:
+    for tmp in state["outputs"]:
+        if tmp not in keep:
+            try:
+                Path(tmp).unlink(missing_ok=True)
+            except OSError:
+                pass
+
+# Undo exactly what an interrupted run changed: swapped-in files and restored orphans get their
+# previous content back, staged outputs and backups it created are removed. -> files put back
+def rollback_journal(state: dict, path: Path = JOURNAL_PATH) -> int:
+    undone = 0
+    commit = state["commit"]
+    files = commit["files"] if commit else [[rec["tmp"], rec["target"], True] for rec in state["staged"].values()]
+    for tmp, dest, existed in files:
+        tmp, dest = Path(tmp), Path(dest)
+        prev = prev_path_for(dest)
+        try:
+            if tmp.exists() or not commit:
+                tmp.unlink(missing_ok=True)  # never swapped in
+                prev.unlink(missing_ok=True)
+            elif prev.exists():
+                os.replace(prev, dest)
+                undone += 1
+            elif not existed:
+                dest.unlink(missing_ok=True)
+                undone += 1
+            else:
+                log(f"[WARN] Cannot roll back {dest}: its previous content was not kept")
+        except OSError as e:
+            log(f"[ERROR] Rolling back {dest}: {e}")
+    for rec in reversed(state["restored"]):
+        dest = Path(rec["target"])
+        prev = prev_path_for(dest)
+        try:
+            if prev.exists():
+                os.replace(prev, dest)
+                undone += 1
+        except OSError as e:
+            log(f"[ERROR] Rolling back {dest}: {e}")
+    for b in state["backups"]:
+        try:
+            Path(b).unlink(missing_ok=True)
+        except OSError:
+            pass
+    _sweep_outputs(state, keep=set())
+    path.unlink(missing_ok=True)
+    return undone
+
+
+# Plan mode: put the would-be output and its unified diff against the live file under plan_dir
+def _stage_plan_output(res: FileResult, plan_dir: Path, full_path: Path, new_content: str, new_raw: bytes,
+                       pending_events: List[str]) -> FileResult:
+    log = res.log_lines.append
+    try:
+        live_raw = full_path.read_bytes() if full_path.exists() else b""
+    except OSError:
+        live_raw = b""
+    if live_raw == new_raw:
+        res.plan = {"action": "unchanged"}
+        log(f"\t     [NO CHANGE]         (plan) File is already up-to-date")
+        return res
+
+    staged = plan_dir / "files" / res.label / res.rel
+    diff_path = plan_dir / "diffs" / res.label / (res.rel + ".diff")
+    try:
+        staged.parent.mkdir(parents=True, exist_ok=True)
+        staged.write_bytes(new_raw)
+        live_text = decode_best_effort(live_raw)[0] if live_raw else ""
+        diff = difflib.unified_diff(live_text.splitlines(keepends=True), new_content.splitlines(keepends=True),
+                                    fromfile=f"a/{res.rel}", tofile=f"b/{res.rel}")
+        diff_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(diff_path, "w", encoding="utf-8", newline="\n") as f:
+            for ln in diff:
+                f.write(ln if ln.endswith("\n") else ln + "\n\\ No newline at end of file\n")
+    except Exception as e:
+        log(f"\t     [ERROR] Staging planned output {staged}: {e}")
+        return res
+
+    res.plan = {"action": "update", "staged": staged.relative_to(plan_dir).as_posix(), "diff": diff_path.relative_to(plan_dir).as_posix()}
+    log(f"\t     [UPDATE FILE]       (plan) Staged, game file not written")
+    for ev in pending_events:
+        log("\t\t" + ev)
+    return res
+
+def _patch_target_job(job: Tuple[FileRules, str, Path, RunOptions, Optional[dict]]) -> FileResult:
+    res = patch_target_file(*job)
+    res.new_patterns = drain_new_pattern_sources()
+    return res
+
+# Serial run as a three-stage pipeline: reader threads prefetch sources and live-file stats up to
+# `depth` jobs ahead, this thread patches, one writer thread stages the outputs. At most `depth`
+# results wait for their write; they are handed out in job order.
+def _run_pipelined(jobs: List[Tuple[FileRules, str, Path, RunOptions, Optional[dict]]], depth: int) -> Iterator[FileResult]:
+    from concurrent.futures import ThreadPoolExecutor
+    from collections import deque
+
+    def _finish(res: FileResult) -> FileResult:
+        if res.pending_write is not None:
+            res.pending_write.result()
+            res.pending_write = None
+        return res
+
+    with ThreadPoolExecutor(max_workers=max(1, PREFETCH_WORKERS)) as readers, ThreadPoolExecutor(max_workers=1) as writer:
+        reads = deque(readers.submit(prefetch_job, *job) for job in jobs[:depth])
+        waiting: deque = deque()
+        for i, job in enumerate(jobs):
+            pre = reads.popleft().result()
+            if i + depth < len(jobs):
+                reads.append(readers.submit(prefetch_job, *jobs[i + depth]))
+            res = patch_target_file(*job, pre=pre, writer=writer)
+            res.new_patterns = drain_new_pattern_sources()
+            waiting.append(res)
+            while waiting and (len(waiting) > depth or waiting[0].pending_write is None or waiting[0].pending_write.done()):
+                yield _finish(waiting.popleft())
+        while waiting:
+            yield _finish(waiting.popleft())
+
+# Serial by default (pipelined, see PIPELINE_DEPTH); PARALLEL_PATCHING sends the jobs to a process pool.
+# Results come back in job order.
+def run_patch_jobs(jobs: List[Tuple[FileRules, str, Path, Optional[dict]]], opts: RunOptions) -> Iterator[FileResult]:
+    full_jobs = [(rules, label, root, opts, prev) for rules, label, root, prev in jobs]
+    workers = PARALLEL_MAX_WORKERS or os.cpu_count() or 1
+    if not PARALLEL_PATCHING or workers < 2 or len(full_jobs) < 2:
+        if PIPELINE_DEPTH > 0 and len(full_jobs) > 1:
+            yield from _run_pipelined(full_jobs, PIPELINE_DEPTH)
+            return
+        for job in full_jobs:
+            yield _patch_target_job(job)
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+    workers = min(workers, len(full_jobs))
+    log(f"[INFO] Parallel patching: {workers} worker processes")
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        try:
+            yield from pool.map(_patch_target_job, full_jobs, chunksize=max(1, len(full_jobs) // (workers * 4)))
+        except GeneratorExit:
+            pool.shutdown(cancel_futures=True)  # run cancelled: drop the jobs not started yet
+            raise
+
+
+# Plan mode report: every file that would change, its diff and which mod rules matched how often
+def write_plan_summary(plan_dir: Path, mods: List[Mod], files: List[dict], restored_orphans: int) -> None:
+    summary = {
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "mods": [m.name for m in mods],
+        "orphans_to_restore": restored_orphans,
+        "files": files,
+    }
+    try:
+        (plan_dir / "summary.json").write_text(json.dumps(summary, indent=2, ensure_ascii=False), encoding="utf-8")
+    except Exception as e:
+        log(f"[ERROR] Writing plan summary: {e}")
+
+
 # =====================================
 #               MAIN
 # =====================================
 
-def main() -> None:
+# cancel: set from another thread (the GUI) to stop the run between files; staged outputs are then
+# discarded, so no game file is left half-patched. progress(phase, files done, files total) is
+# called from the thread running main().
+def main(cancel: Optional[threading.Event] = None, progress: Optional[Callable[[str, int, int], None]] = None) -> None:
+    def _progress(phase: str, done: int = 0, total: int = 0) -> None:
+        if progress is not None:
+            progress(phase, done, total)
+
+    def _cancelled() -> bool:
+        return cancel is not None and cancel.is_set()
+
     print(""), log(f'STARTING MODLOADER PROCESS...')
+    _progress("scan")
 
     # Find Steam Workshop root
     ws_root = find_workshop_content_root(game_root)
@@ -895,6 +3348,23 @@ def main() -> None:
         return
     _sync_stored_buildid_to_current()
 
+    # Interrupted previous run: undo it, or finish its commit / reuse the outputs it staged
+    resumed_staged: Dict[str, dict] = {}
+    interrupted = read_journal() if not PLAN_MODE else None
+    if interrupted is not None:
+        log(f"[INFO] The previous run was interrupted ({describe_journal(interrupted)})")
+        if JOURNAL_ACTION == "rollback":
+            undone = rollback_journal(interrupted)
+            log(f"[INFO] Rolled back {undone} file(s) changed by the interrupted run")
+            log("[REPORT] ROLLBACK FINISHED!"), print('\n')
+            return
+        done = resume_journal(interrupted)
+        if interrupted["commit"]:
+            log(f"[INFO] Resumed: wrote the {done} remaining updated file(s) of the interrupted run")
+        else:
+            resumed_staged = {k: dict(rec["ledger"], resumed=True) for k, rec in interrupted["staged"].items() if rec.get("ledger")}
+            log(f"[INFO] Resuming: {len(resumed_staged)} file(s) prepared by the interrupted run are reused if still valid")
+
     # 1) Discover mods
     mods = discover_all_mods(mods_dir, ws_root)
     
@@ -942,30 +3412,86 @@ def main() -> None:
         return
 
 
-    # 3) Load all replacement bundles in order, merge so that later mods override
+    # 3) Load all replacement bundles in order, merge so that later mods override.
+    # SELECTIVE_RUN: only the mods that changed since the last run plus the mods sharing a file with them.
+    ledger = _load_ledger() if not PLAN_MODE else {}
+    mod_info = {m.name: mod_signature(m) for m in mods}
+    labels = [label for label, _ in targets]
+    file_index = load_file_index() if SELECTIVE_RUN and not interrupted else None
+    selection = select_changed_files(file_index, mods, mod_info, labels, targets, ledger) if file_index else None
+    if SELECTIVE_RUN and selection is None:
+        log("[INFO] SELECTIVE_RUN --> no usable index from an earlier run, re-applying all mods")
+    # Glob rule keys become the game files they match, per mod, so mod priority is kept
+    globs = GlobExpander(targets, BACKUP_DIR)
+    load_bundle = lambda m: globs.expand(load_bundle_from_mod(m))
+    bundles: Dict[str, ReplBundle] = {}
+    if selection is None:
+        for m in mods:
+            bundles[m.name] = load_bundle(m)
+    else:
+        changed, affected = selection
+        for m in mods:
+            if m.name in changed:
+                bundles[m.name] = load_bundle(m)
+                affected |= bundles[m.name].file_keys()
+        sharing = {name for rel in affected for name in file_index["files"].get(rel, {}).get("mods", [])}
+        for m in mods:
+            if m.name in sharing and m.name not in bundles:
+                bundles[m.name] = load_bundle(m)
     merged = ReplBundle()
     for m in mods:
-        b = load_bundle_from_mod(m)
-        merged.merge_from(b)
+        if m.name in bundles:
+            merged.merge_from(bundles[m.name])
 
     # 4) Determine all target file paths (no explicit targets: union of keys used anywhere)
-    file_keys = set()
-    file_keys.update(merged.line_replacements.keys())
-    file_keys.update(merged.function_replacements.keys())
-    file_keys.update(merged.file_line_replacements.keys())
-    file_keys.update(merged.file_additions.keys())
-    file_keys.update(merged.file_replacements.keys())
+    file_keys = merged.file_keys()
+    active_keys = set(file_keys)
+    trusted: set = set()
+    if selection is not None:
+        trusted = set(file_index["files"]) - affected
+        active_keys |= trusted
+        file_keys &= affected
+        log(f"[INFO] SELECTIVE_RUN --> {len(changed)} changed mod(s), {len(affected)} file(s) to re-apply, "
+            f"{len(trusted)} file(s) unchanged")
     
+    # Plan mode: fresh staging dir, nothing in the game folders or backups is touched
+    opts = RunOptions(BACKUP_DIR, fsync_policy=FSYNC_POLICY, engine=MATCH_ENGINE, slow_rule_secs=SLOW_RULE_SECONDS)
+    if PLAN_MODE:
+        log(f"[INFO] PLAN_MODE --> dry run, planned changes go to {PLAN_DIR}")
+        shutil.rmtree(PLAN_DIR, ignore_errors=True)
+        PLAN_DIR.mkdir(parents=True, exist_ok=True)
+        opts.plan_dir = PLAN_DIR
+
+    if _cancelled():
+        log("[INFO] Run cancelled - no game files were changed")
+        _progress("cancelled")
+        print('')
+        return
+
+    # Journal of this run's file operations (see RUN JOURNAL), removed again when the run ends
+    journal = RunJournal() if not PLAN_MODE else None
+    if journal is not None:
+        journal.record("begin", sync=True, time=time.strftime("%Y-%m-%d %H:%M:%S"))
+
     # 5) Restore orphaned files (files that have backups but are no longer targeted by any enabled
-    restored_orphans = restore_orphaned_files(BACKUP_DIR, targets, file_keys)
+    _progress("restore")
+    restored_orphans = restore_orphaned_files(BACKUP_DIR, targets, active_keys, dry_run=PLAN_MODE, journal=journal)
     if restored_orphans > 0:
         log(f"[INFO] Restored {restored_orphans} orphaned file(s) from backups.")  
 
+    if not file_keys and selection is not None:
+        log("[INFO] SELECTIVE_RUN --> nothing to re-apply")
+        if journal is not None:
+            save_file_index(mod_info, labels, file_index_entries(bundles, file_index, trusted))
+            journal.finish()
+        return
     if not file_keys:
         if restored_orphans == 0:
             log("[INFO] No replacement rules found across enabled mods. Nothing to do.")
         else:
             log("[INFO] No replacement rules found across enabled mods. Done.")
+        if journal is not None:
+            journal.finish()
         return
 
 
@@ -977,248 +3503,86 @@ def main() -> None:
     # Ensure backup dir exists
     BACKUP_DIR.mkdir(parents=True, exist_ok=True)
 
-    # 7) PROCESS FILES
+    # 7) PROCESS FILES (one unit per file and target, results logged in this order)
+    new_ledger: Dict[str, dict] = {k: ledger[k] for rel in trusted for k in (f"{label}/{rel}" for label in labels) if k in ledger}
+    jobs: List[Tuple[FileRules, str, Path, Optional[dict]]] = []
+    file_rules: Dict[str, FileRules] = {}
     for rel in sorted(file_keys):
-        target_rel = Path(rel)  # Path to file, example: "Program/interface/seadogs.c"
-
+        rules = file_rules[rel] = build_file_rules(merged, rel)
         for label, root in targets:
-            filename_display = f"{rel} ({label})"
-            full_path = root / target_rel
-            
-            # Load all shit
-            funcs_lines = merged.line_replacements.get(rel, {})
-            funcs_full  = merged.function_replacements.get(rel, {})
-            if rel == "Program/colonies/Colonies_init.c":
-                log(f"\t     [DEBUG] funcs_lines keys: {list(funcs_lines.keys())}")
-                log(f"\t     [DEBUG] funcs_full keys: {list(funcs_full.keys())}")
-            file_line_repls = merged.file_line_replacements.get(rel, [])
-            file_adds   = merged.file_additions.get(rel, [])
-            spec_file   = merged.file_replacements.get(rel)  
-            
-            
-            
-            # Leave idle files for logging
-            backup_path = BACKUP_DIR / label / target_rel
-            exists_now = full_path.exists()
-            had_backup = backup_path.exists()
-            if not exists_now and not had_backup:
-                continue
-            
-            log(f"==> {filename_display}")
-
-            # Ensure backup exists (create once)
-            try:
-                if exists_now:
-                    if not had_backup:
-                        backup_path.parent.mkdir(parents=True, exist_ok=True)
-                        try:
-                            shutil.copy2(full_path, backup_path)
-                            log(f"\t     [BACKUP CREATED]")
-                            had_backup = True
-                        except Exception as e:
-                            log(f"\t     [ERROR] Could not create backup! {e}")
-                else:                    
-                    log(f"\t     [INFO] Target missing, will use existing backup")
-            except Exception as e:
-                log(f"\t     [ERROR] Checking/creating backup {e}")
-                continue
-
-            # Source: always a backup of the original if we have it, otherwise a live file
-            source_path = backup_path if backup_path.exists() else full_path
-            try:
-                source_text, source_enc = read_text_best_effort(source_path)
-            except FileNotFoundError:
-                log(f"\t|     [WARN] Source file not found, skipping...")
-                continue
-
-
-
-            pending_events: List[str] = []
-            source_lines = source_text.splitlines(keepends=True)
-            out_lines: List[str] = []
-
-            # --- state for function capture ---
-            in_function: Optional[str] = None
-            brace_level = 0
-            wait_for_brace = False
-            buffer_lines: List[str] = []
-
-            # ---------- function-scope processing ----------
-            source_lines_iter = iter(source_lines)
-            for raw_line in source_lines_iter:
-                line = raw_line
-                stripped = line.rstrip('\n')
-
-                if in_function is None:
-                    
-                    # Check 'detected'
-                    detected: Optional[str] = None
-                    header_complete = False                    
-                    for func_name in set(list(funcs_lines.keys()) + list(funcs_full.keys())):                        
-                        d, c = is_function_header_or_start(stripped, func_name)
-                        if d:
-                            detected = func_name
-                            header_complete = c
-                            break
-                    if detected is None:
-                        out_lines.append(line)
-                        continue
-
-                    # Start capture
-                    in_function = detected
-                    buffer_lines = [line]
-                    
-                    # Jeśli ) nie było w tej linii, dociągamy nagłówek aż do zamknięcia ')'
-                    if not header_complete:
-                        ln = strip_c_line_comments(stripped)
-                        paren_depth = ln.count('(') - ln.count(')')
-                        continue_capture = True
-                        while continue_capture:
-                            try:
-                                next_raw = next(source_lines_iter)
-                            except StopIteration:
-                                break
-                            buffer_lines.append(next_raw)
-                            nr = next_raw.rstrip('\n')
-                            lnc = strip_c_line_comments(nr)
-                            paren_depth += lnc.count('(') - lnc.count(')')
-                            if paren_depth <= 0:
-                                continue_capture = False
-                        wait_for_brace = True
-                        continue
-                    
-                    if '{' in stripped and not stripped.strip().endswith(';'):
-                        brace_level = stripped.count('{') - stripped.count('}')
-                        wait_for_brace = False
-                    else:
-                        wait_for_brace = True
-                    continue                
-
-                # Inside function capture
-                buffer_lines.append(line)
-
-                if wait_for_brace:
-                    if '{' in stripped:
-                        brace_level = stripped.count('{') - stripped.count('}')
-                        wait_for_brace = False
-                else:
-                    code_part = stripped.split("//", 1)[0]   # utnie komentarz liniowy
-                    brace_level += code_part.count("{") - code_part.count("}")
-
-                if brace_level <= 0 and not wait_for_brace:
-                    func_text = ''.join(buffer_lines)
-
-                    # Decide output: full-function swap (preferred) or modified original
-                    out_text = None
-                    if in_function in funcs_full:
-                        spec = funcs_full[in_function]
-                        new_text = load_function_replacement(spec) if isinstance(spec, str) else str(spec)
-                        out_text = new_text
-                        file_func_swaps[f"{label}/{rel}"] += 1
-                        pending_events.append(f"\t > [REPLACE FUNCTION]  {in_function}\t\t`{str(spec)[:50]}`")
-                    else:
-                        # Apply line/block replacements (multiline-aware)
-                        for old, new_spec in funcs_lines.get(in_function, []):                            
-                            old_text = resolve_line_spec_to_text(old) if isinstance(old, str) else str(old)
-                            pat = make_ws_agnostic_pattern(old_text)
-                            replacement = load_line_replacement(new_spec) if isinstance(new_spec, str) else str(new_spec)
-                            
-                            func_text, n = pat.subn(_safe_re_sub_repl(replacement), func_text, count=1)
-                            if n > 0:
-                                file_stats[f"{label}/{rel}"][in_function] += n
-                                new_spec_log = ' '.join(str(new_spec).split())
-                                pending_events.append(f"\t > [REPLACE LINE]      {in_function}\t\t`{new_spec_log[:50]}`")
-
-                        out_text = func_text
-
-                    # Emit processed function ONCE
-                    out_lines.append(out_text)
-
-                    # Reset capture state
-                    in_function = None
-                    buffer_lines = []
-                    brace_level = 0
-                    wait_for_brace = False
-
-                    continue
-
-            # Jeśli niedomknięta funkcja – flush
-            if buffer_lines:
-                out_lines.append(''.join(buffer_lines))
-                buffer_lines = []
-
-            new_content = ''.join(out_lines)
-
-            # ---------- file-level replacements & additions ----------
-            if file_line_repls:
-                for old, new_spec in file_line_repls:
-                    old_text = resolve_line_spec_to_text(old) if isinstance(old, str) else str(old)
-                    pat = make_ws_agnostic_pattern(old_text)
-                    replacement = load_line_replacement(new_spec) if isinstance(new_spec, str) else str(new_spec)
-                    matches = list(pat.finditer(new_content))
-                    if matches:
-                        new_content = pat.sub(_safe_re_sub_repl(replacement), new_content)
-                        pending_events.append(f"\t > [REPLACE FILE-LINE] {rel} -> `{str(new_spec)[:60]}`")
-                        file_stats[f"{label}/{rel}"]['<file>'] += len(matches)
-
-            if file_adds:
-                for position, spec in file_adds:
-                    addition = load_line_replacement(spec) if isinstance(spec, str) else str(spec)
-                    if not addition:
-                        continue
-                    if position == 'start':
-                        if addition in new_content:
-                            pending_events.append(f"\t > [ADD SKIP] {rel} start -> `{str(spec)[:60]}` already present")
-                        else:
-                            sep = ''
-                            if (not new_content.startswith('\n')) and (not addition.endswith('\n')) and new_content:
-                                sep = '\n'
-                            new_content = addition + sep + new_content
-                            pending_events.append(f"\t > [ADD START] {rel} -> `{str(spec)[:60]}`")
-                    else:
-                        if addition in new_content:
-                            pending_events.append(f"\t > [ADD SKIP] {rel} end -> `{str(spec)[:60]}` already present")
-                        else:
-                            sep = ''
-                            if (not new_content.endswith('\n')) and (not addition.startswith('\n')) and new_content:
-                                sep = '\n'
-                            new_content = new_content + sep + addition
-                            pending_events.append(f"\t > [ADD END] {rel} -> `{str(spec)[:60]}`")
-
-            if spec_file is not None:
-                replacement = load_file_replacement(spec_file) if isinstance(spec_file, str) else str(spec_file)
-                if replacement != new_content:
-                    new_content = replacement
-                    pending_events.append(f"\t > [FILE REPLACE] {rel} -> `{str(spec_file)[:60]}`")
-                    file_stats[f"{label}/{rel}"]['<file>'] += 1
-                    file_file_swaps[f"{label}/{rel}"] += 1
-                else:
-                    pending_events.append(f"\t > [FILE REPLACE] {rel} -> already up-to-date")
-
-            # Read current target file content (may be missing)
-            try:
-                current_content = read_text_best_effort(full_path)[0] if full_path.exists() else ''
-            except FileNotFoundError:
-                current_content = ''
-
-            # If nothing changed compared to current live file, skip write
-            if new_content == current_content:
-                if pending_events:
-                    log(f"\t     [NO CHANGE]         File is already up-to-date")
-                else:
-                    log(f"\t     [NO CHANGE]         No write needed")
-                continue
-
-            # Write new file
-            try:
-                full_path.parent.mkdir(parents=True, exist_ok=True)
-                full_path.write_text(new_content, encoding=source_enc)
-                log(f"\t     [UPDATE FILE]")
-                for ev in pending_events:
-                    log("\t\t" + ev)
-            except Exception as e:
-                log(f"\t     [ERROR] Writing updated file {full_path}: {e}")
-                continue
+            jobs.append((rules, label, root, resumed_staged.get(f"{label}/{rel}") or ledger.get(f"{label}/{rel}")))
+
+    plan_files: List[dict] = []
+    staged: List[Tuple[Path, Path]] = []
+    new_patterns: Dict[str, Tuple[str, int]] = {}
+    failed = 0
+    job_outputs = [(staged_path_for(root / rules.rel), root / rules.rel) for rules, _, root, _ in jobs]
+    if journal is not None:
+        journal.record("outputs", sync=True, tmp=[str(tmp) for tmp, _ in job_outputs])
+    done = 0
+    _progress("patch", done, len(jobs))
+    results = run_patch_jobs(jobs, opts)
+    try:
+        for res in results:
+            for ln in res.log_lines:
+                log(ln)
+            key = f"{res.label}/{res.rel}"
+            new_patterns.update(res.new_patterns)
+            if res.staged is not None:
+                staged.append(res.staged)
+            if journal is not None:
+                if res.backup_created is not None:
+                    journal.record("backup", path=str(res.backup_created))
+                if res.staged is not None:
+                    journal.record("staged", key=key, tmp=str(res.staged[0]), target=str(res.staged[1]), ledger=res.ledger)
+            failed += res.failed
+            if res.plan is not None:
+                rules_desc = [dict(r, hits=res.rule_hits.get(r["id"], 0)) for r in file_rules[res.rel].describe()]
+                plan_files.append(dict(res.plan, file=res.rel, target=res.label, rules=rules_desc))
+            if res.ledger is not None:
+                new_ledger[key] = res.ledger
+            for func, cnt in res.stats.items():
+                file_stats[key][func] += cnt
+            if res.func_swaps:
+                file_func_swaps[key] += res.func_swaps
+            if res.file_swaps:
+                file_file_swaps[key] += res.file_swaps
+            done += 1
+            _progress("patch", done, len(jobs))
+            if done < len(jobs) and _cancelled():
+                break
+    except BaseException:
+        results.close()
+        discard_staged_writes(job_outputs)
+        if journal is not None:
+            journal.finish()
+        raise
+    if done < len(jobs):
+        # Cancelled between files: nothing staged so far reaches the game folders
+        results.close()
+        discard_staged_writes(job_outputs)
+        if journal is not None:
+            journal.finish()
+        log(f"[INFO] Run cancelled after {done} of {len(jobs)} file(s) - no patched files were written")
+        _progress("cancelled", done, len(jobs))
+        print('')
+        return
+    save_pattern_cache({t for r in file_rules.values() for t in r.anchors}, new_patterns)
+    if PLAN_MODE:
+        write_plan_summary(PLAN_DIR, mods, plan_files, restored_orphans)
+    elif failed:
+        # All or nothing: keep the game exactly as it was before this run
+        discard_staged_writes(staged)
+        log(f"[ERROR] {failed} file(s) could not be written - no changes were applied to the game files")
+        journal.finish()
+    else:
+        _progress("commit", 0, len(staged))
+        committed = commit_staged_writes(staged, FSYNC_POLICY, journal, new_ledger)
+        if committed:
+            log(f"[INFO] Committed {committed} updated file(s)")
+        _save_ledger(new_ledger)
+        save_file_index(mod_info, labels, file_index_entries(bundles, file_index, trusted))
+        journal.finish()
 
 
     # Summary
@@ -1237,12 +3601,15 @@ def main() -> None:
         log(f" | {fname:<{_max_len}}\t replaced {cnt} file(s)")
 
     # report
+    if PLAN_MODE:
+        log(f"\n[REPORT] PLAN FINISHED! No game files were changed. Diffs and summary.json are in {PLAN_DIR}")
     error_status = f"There are {ERROR_COUNT} errors!" if ERROR_COUNT > 0 else "No errors detected."
     log(f"\nMODLOADER FINISHED! Loaded total {len(mods)} mods, changed {_total_line_changes} lines, {_total_func_swaps} functions, and {_total_file_swaps} files. {error_status}")    
     if ERROR_COUNT > 0:
         log(f" | Warning! Game may CRASH! You should check logs for details and fix all {ERROR_COUNT} errros")
     if WARN_COUNT > 0:
         log(f" | Warning! There are {WARN_COUNT} files that require your attention! Check [WARN] logs for details")
+    _progress("done", len(jobs), len(jobs))
     print('')    
     
 if __name__ == "__main__":
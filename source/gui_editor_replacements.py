@@ -59,6 +59,8 @@ def _safe_exec_replacements(py_path: Path) -> Dict[str, Any]:
         "FILE_LINE_REPLACEMENTS": {},
         "FILE_ADDITIONS": {},
         "FILE_REPLACEMENTS": {},
+        "INI_REPLACEMENTS": {},
+        "FILE_PATCHES": {},
     }
     if not py_path.exists():
         return env
@@ -123,6 +125,12 @@ def _normalize_payload(payload: Dict[str, Any]) -> Dict[str, Any]:
         for f, val in frr.items():
             frr_out[str(f)] = str(val)
     norm["FILE_REPLACEMENTS"] = frr_out
+    # INI_REPLACEMENTS (no editor page yet: kept as written)
+    ini = payload.get("INI_REPLACEMENTS", {})
+    norm["INI_REPLACEMENTS"] = {str(f): sections for f, sections in ini.items()} if isinstance(ini, dict) else {}
+    # FILE_PATCHES (kept as written)
+    fp = payload.get("FILE_PATCHES", {})
+    norm["FILE_PATCHES"] = {str(f): patches for f, patches in fp.items()} if isinstance(fp, dict) else {}
     return norm
 
 
@@ -178,6 +186,8 @@ def _generate_py(data: Dict[str, Any]) -> str:
         "FILE_LINE_REPLACEMENTS",
         "FILE_ADDITIONS",
         "FILE_REPLACEMENTS",
+        "INI_REPLACEMENTS",
+        "FILE_PATCHES",
     ]:
         obj = data.get(key, {})
         parts.append(f"{key} = " + _py_dump(obj, indent=0))
@@ -417,6 +427,8 @@ class ReplacementsBrowser:
             "FILE_LINE_REPLACEMENTS":  dict(env.get("FILE_LINE_REPLACEMENTS", {})),
             "FILE_ADDITIONS":          dict(env.get("FILE_ADDITIONS", {})),
             "FILE_REPLACEMENTS":       dict(env.get("FILE_REPLACEMENTS", {})),
+            "INI_REPLACEMENTS":        dict(env.get("INI_REPLACEMENTS", {})),
+            "FILE_PATCHES":            dict(env.get("FILE_PATCHES", {})),
         }
 
         self._cards: List[tk.Frame] = []
@@ -851,7 +863,7 @@ class ReplacementsBrowser:
         ):
             return
 
-        for sect in ("LINE_REPLACEMENTS", "FUNCTION_REPLACEMENTS", "FILE_LINE_REPLACEMENTS", "FILE_ADDITIONS", "FILE_REPLACEMENTS"):
+        for sect in ("LINE_REPLACEMENTS", "FUNCTION_REPLACEMENTS", "FILE_LINE_REPLACEMENTS", "FILE_ADDITIONS", "FILE_REPLACEMENTS", "INI_REPLACEMENTS", "FILE_PATCHES"):
             branch = self.payload.get(sect)
             if isinstance(branch, dict):
                 branch.pop(file_key, None)
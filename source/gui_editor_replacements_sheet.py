@@ -1760,6 +1760,12 @@ def flush_current(self):
 # ====== Additions (BEGIN/END + text) ======
 AdditionItem = Tuple[str, str]
 
+# "begin"/"end" of the file, or anchored to a function: "before:Func", "after:Func", "start:Func", "end:Func"
+def _addition_pos_ok(pos) -> bool:
+    if pos in ("begin", "end"):
+        return True
+    return isinstance(pos, str) and pos.partition(":")[0] in ("before", "after", "start", "end") and bool(pos.partition(":")[2].strip())
+
 
 class EditorAdditions(ttk.Frame):
 
@@ -1783,7 +1789,7 @@ class EditorAdditions(ttk.Frame):
                         pos, txt = it[0], it[1]
                     else:
                         pos, txt = "end", it
-                    pos = pos if pos in ("begin","end") else "end"
+                    pos = pos if _addition_pos_ok(pos) else "end"
                     norm.append((pos, str(txt) if txt is not None else ""))
             return (file_key, _copy.deepcopy(norm))
 
@@ -1913,7 +1919,7 @@ class EditorAdditions(ttk.Frame):
         coerced: List[AdditionItem] = []
         changed = False
         for it in raw:
-            if isinstance(it, tuple) and len(it)==2 and it[0] in ("begin","end"):
+            if isinstance(it, tuple) and len(it)==2 and _addition_pos_ok(it[0]):
                 coerced.append((it[0], it[1]))
             else:
                 coerced.append(("end", str(it))); changed = True
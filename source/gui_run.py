@@ -3,7 +3,7 @@
 
 from __future__ import annotations
 
-import os, re, sys, queue, threading, math, datetime as dt
+import os, re, sys, queue, threading, math, time, datetime as dt
 from pathlib import Path
 from contextlib import redirect_stdout, redirect_stderr
 from typing import Optional
@@ -81,13 +81,14 @@ INLINE_STATUS_STYLE = {
     "REPLACE FUNCTION":  ("STATUS_UPDATE",     LOG_PALETTE["action"]),
     "ADD START":         ("STATUS_UPDATE",     LOG_PALETTE["action"]),
     "ADD END":           ("STATUS_UPDATE",     LOG_PALETTE["action"]),
+    "ADD UPDATE":        ("STATUS_UPDATE",     LOG_PALETTE["action"]),
     "SUMMARY":           ("HEADER_SUMMARY",    LOG_PALETTE["summary"]),
 }
 
 # Precompiled regexes
 RE_TIME     = re.compile(r"^\[\d{1,2}:\d{2}:\d{2}\]\s*")
 RE_INFOHDR  = re.compile(r"^\[\d{1,2}:\d{2}:\d{2}\]\s*\[(INFO|WARN|ERROR)\]")
-RE_STATUS   = re.compile(r"\[(NO CHANGE|BACKUP CREATED|BACKUP RESTORED|UPDATE FILE|FILE REPLACE|REPLACE LINE|REPLACE FILE|REPLACE FILE-LINE|REPLACE FUNCTION|ADD START|ADD END)\]")
+RE_STATUS   = re.compile(r"\[(NO CHANGE|BACKUP CREATED|BACKUP RESTORED|UPDATE FILE|FILE REPLACE|REPLACE LINE|REPLACE FILE|REPLACE FILE-LINE|REPLACE FUNCTION|ADD START|ADD END|ADD UPDATE)\]")
 RE_SUMMARYH = re.compile(r"^\[\d{1,2}:\d{2}:\d{2}\]\s*\[SUMMARY\]")
 RE_REPORT   = re.compile(r"^\[REPORT\]\s")
 RE_ARROW    = re.compile(r"^\[\d{1,2}:\d{2}:\d{2}\]\s*==> ")
@@ -198,6 +199,9 @@ class ModLoaderApp(tk.Tk):
         self._progress_running = False
         self._progress_phase = 0.0
         self._progress_fill = 0.0
+        self._progress_state: Optional[tuple] = None  # (phase, done, total) reported by ModLoader.main()
+        self._progress_started = 0.0  # monotonic time of the first "patch" report, for the ETA
+        self._cancel_event: Optional[threading.Event] = None
         self._collecting_mods = False
         self.err_count = 0
         self.warn_count = 0
@@ -234,6 +238,7 @@ class ModLoaderApp(tk.Tk):
         
         #self.after(0, self._update_restore_button_state) # Initial state of 'Restore vanilla files' based on backups
         self.after(0, self._startup_update_guard) # check Steam game updates
+        self.after(400, self._check_interrupted_run) # last run killed mid-way? offer resume / rollback
 
         # Center only on first run (no saved geometry/position)
         if not getattr(self, "_restored_geometry", False):
@@ -399,6 +404,16 @@ class ModLoaderApp(tk.Tk):
         right_box.grid(row=0, column=1, sticky="e")
         btn_pack = {"side":"left", "padx":(0,8)}
 
+        # BUTTON: Cancel run (enabled while a run is in progress)
+        self.btn_cancel = Button(right_box, text="Cancel run", command=self.on_cancel_clicked, pack=btn_pack, tooltip="Stops the run after the current file. Game files are only written at the end, so nothing is left half-patched")
+        self.btn_cancel.set_enabled(False)
+
+        # BUTTON: Apply changed mods (selective run)
+        self.btn_selective = Button(right_box, text="Apply changed mods", command=self.on_selective_clicked, pack=btn_pack, tooltip="Re-applies only the files touched by mods you enabled, disabled, reordered or edited since the last run (Ctrl+Shift+A)")
+
+        # BUTTON: Preview changes (plan run)
+        self.btn_plan = Button(right_box, text="Preview changes", command=self.on_plan_clicked, pack=btn_pack, tooltip="Dry run: writes diffs and a summary to assets/plan without touching game files (Ctrl+Shift+P)")
+
         # BUTTON: Purge backup files
         self.btn_purge_backups = Button(right_box, text="Purge backup files", command=self.on_purge_backups_clicked, pack=btn_pack, tooltip="Deletes backup files created by ModLoader (ALWAYS use after game update)")
         
@@ -518,6 +533,24 @@ class ModLoaderApp(tk.Tk):
 
     # ---------- UPDATE GUARD ----------
 
+    # A run journal left behind means the last run crashed or was killed: resume or roll it back
+    def _check_interrupted_run(self):
+        try:
+            state = ModLoader.read_journal()
+        except Exception:
+            return
+        if state is None or (self._worker and self._worker.is_alive()):
+            return
+        choice = messagebox.askyesnocancel(
+            "Interrupted run",
+            "The last ModLoader run did not finish ({}).\n\n"
+            "Yes: resume it - only the files it did not finish are processed.\n"
+            "No: roll back exactly the files it changed.\n"
+            "Cancel: decide later (the next RUN resumes it).".format(ModLoader.describe_journal(state)))
+        if choice is None:
+            return
+        self._start_worker(factory=False, purge_backups=False, rollback=not choice)
+
     def _startup_update_guard(self):
         try:
             ok, msg = ModLoader.preflight_check(mode="run")
@@ -981,7 +1014,7 @@ class ModLoaderApp(tk.Tk):
         self.txt.configure(state="disabled")
 
     # ---------- Progress drawing & animation ----------
-    def _draw_progress(self, fill_ratio: float = 0.0):
+    def _draw_progress(self, fill_ratio: float = 0.0, label: str = ""):
         c = self.progress_canvas
         c.delete("all")
         w = c.winfo_width() or 400
@@ -990,10 +1023,29 @@ class ModLoaderApp(tk.Tk):
         fill_w = int(w * max(0.0, min(1.0, fill_ratio)))
         if fill_w > 0:
             c.create_rectangle(2, 2, fill_w - 2 if fill_w > 4 else fill_w, h - 2, outline="", fill=self.accent)
+        if label:
+            c.create_text(w // 2, h // 2, text=label, fill=COLOR["text"], font=FONTS["base_mini"])
+
+    # Called by ModLoader.main() on the worker thread; the tick below draws it
+    def _on_progress(self, phase: str, done: int, total: int):
+        if phase == "patch" and done == 0:
+            self._progress_started = time.monotonic()
+        self._progress_state = (phase, done, total)
 
     def _progress_tick(self):
         if hasattr(self, 'progress_canvas'):
-            if self._progress_running:
+            state = self._progress_state
+            if self._progress_running and state and state[0] in ("patch", "commit") and state[2] > 0:
+                # Real progress: files done / total, ETA from the average time per file so far
+                phase, done, total = state
+                ratio = done / total
+                label = f"{'Patching' if phase == 'patch' else 'Writing'} {done}/{total} files"
+                if phase == "patch" and 0 < done < total:
+                    eta = (time.monotonic() - self._progress_started) / done * (total - done)
+                    label += f"  ·  ~{int(eta) // 60}:{int(eta) % 60:02d} left"
+                self._progress_fill = ratio
+                self._draw_progress(ratio, label)
+            elif self._progress_running:
                 self._progress_phase += 0.13
                 ratio = (math.sin(self._progress_phase) + 1.0) / 2.0
                 bias = 0.2
@@ -1009,6 +1061,18 @@ class ModLoaderApp(tk.Tk):
     def _set_controls_enabled(self, enabled: bool):
         state = "normal" if enabled else "disabled"
         self.btn_run.configure(state=state)
+        try:
+            if hasattr(self, "btn_plan") and self.btn_plan:
+                self.btn_plan.set_enabled(enabled)
+            if hasattr(self, "btn_selective") and self.btn_selective:
+                self.btn_selective.set_enabled(enabled)
+        except Exception:
+            pass
+        try:
+            if hasattr(self, "btn_cancel") and self.btn_cancel:
+                self.btn_cancel.set_enabled(not enabled)
+        except Exception:
+            pass
         if not enabled:
             self._progress_running = True
             self.status_label.configure(text="Status: In progress")
@@ -1042,6 +1106,18 @@ class ModLoaderApp(tk.Tk):
     def on_run_clicked(self):
         self._start_worker(factory=False, purge_backups=False)
 
+    def on_plan_clicked(self):
+        self._start_worker(factory=False, purge_backups=False, plan=True)
+
+    def on_selective_clicked(self):
+        self._start_worker(factory=False, purge_backups=False, selective=True)
+
+    def on_cancel_clicked(self):
+        if self._worker and self._worker.is_alive() and self._cancel_event is not None:
+            self._cancel_event.set()
+            self.btn_cancel.set_enabled(False)
+            self.status_label.configure(text="Status: Cancelling")
+
     def on_factory_reset_clicked(self):
         ok = messagebox.askyesno(
             "Restore vanilla files", 
@@ -1065,7 +1141,8 @@ class ModLoaderApp(tk.Tk):
         self._start_worker(factory=False, purge_backups=True)        
         
 
-    def _start_worker(self, factory: bool, purge_backups: bool = False):
+    def _start_worker(self, factory: bool, purge_backups: bool = False, plan: bool = False, rollback: bool = False,
+                      selective: bool = False):
         if self._worker and self._worker.is_alive():
             messagebox.showinfo("Whale", "Mod Loader is already running")
             return            
@@ -1086,11 +1163,14 @@ class ModLoaderApp(tk.Tk):
                 pass
             return
 
+        self._progress_state = None
+        self._cancel_event = threading.Event()
         self._set_controls_enabled(False)
-        self._worker = threading.Thread(target=self._run_modloader_once, args=(factory, purge_backups), daemon=True)
+        self._worker = threading.Thread(target=self._run_modloader_once, args=(factory, purge_backups, plan, self._cancel_event, rollback, selective), daemon=True)
         self._worker.start()
 
-    def _run_modloader_once(self, factory: bool, purge_backups: bool = False):
+    def _run_modloader_once(self, factory: bool, purge_backups: bool = False, plan: bool = False,
+                            cancel: Optional[threading.Event] = None, rollback: bool = False, selective: bool = False):
         try:
             import importlib
             importlib.reload(ModLoader)
@@ -1102,10 +1182,19 @@ class ModLoaderApp(tk.Tk):
         try:
             setattr(ModLoader, "FACTORY_RESET", bool(factory))
             setattr(ModLoader, "PURGE_BACKUPS_ONLY", bool(purge_backups))
+            setattr(ModLoader, "PLAN_MODE", bool(plan))
+            setattr(ModLoader, "JOURNAL_ACTION", "rollback" if rollback else "resume")
+            setattr(ModLoader, "SELECTIVE_RUN", bool(selective))
             if factory:
                 self.log_queue.put(("STDOUT", "[INFO] FACTORY_RESET=True\n"))
             if purge_backups:
                 self.log_queue.put(("STDOUT", "[INFO] PURGE_BACKUPS_ONLY=True\n"))
+            if plan:
+                self.log_queue.put(("STDOUT", "[INFO] PLAN_MODE=True\n"))
+            if rollback:
+                self.log_queue.put(("STDOUT", "[INFO] JOURNAL_ACTION=rollback\n"))
+            if selective:
+                self.log_queue.put(("STDOUT", "[INFO] SELECTIVE_RUN=True\n"))
         except Exception:
             pass
 
@@ -1126,7 +1215,7 @@ class ModLoaderApp(tk.Tk):
         try:
             with redirect_stdout(q_stdout), redirect_stderr(q_stderr):
                 if hasattr(ModLoader, "main") and callable(ModLoader.main):
-                    ModLoader.main()
+                    ModLoader.main(cancel=cancel, progress=self._on_progress)
                 else:
                     self.log_queue.put(("STDERR", "[ERROR] ModLoader.main() not found.\n"))
         except Exception as e:
@@ -1134,8 +1223,9 @@ class ModLoaderApp(tk.Tk):
         finally:
             end_time = dt.datetime.now()
             self.last_run_end = end_time
+            cancelled = cancel is not None and cancel.is_set()
             self.after(0, lambda: self._set_controls_enabled(True))
-            self.after(0, lambda: self.status_label.configure(text="Status: Done"))
+            self.after(0, lambda: self.status_label.configure(text="Status: Cancelled" if cancelled else "Status: Done"))
             self.after(1200, lambda: self.status_label.configure(text="Status: Idle"))
 
             # Refreshes
@@ -1316,6 +1406,8 @@ class ModLoaderApp(tk.Tk):
     def _bind_shortcuts(self):
         self.bind("<Control-r>", lambda e: self.on_run_clicked())
         self.bind("<Control-Shift-R>", lambda e: self.on_factory_reset_clicked())
+        self.bind("<Control-Shift-P>", lambda e: self.on_plan_clicked())
+        self.bind("<Control-Shift-A>", lambda e: self.on_selective_clicked())
         self.bind("<Control-s>", lambda e: self.save_log())
         self.bind("<Control-l>", lambda e: self.clear_log())
         self.bind("<Control-f>", lambda e: (
@@ -1441,4 +1533,7 @@ def main():
     app.mainloop()
 
 if __name__ == "__main__":
+    # Worker processes of the frozen .exe (ModLoader.PARALLEL_PATCHING) start here
+    import multiprocessing
+    multiprocessing.freeze_support()
     main()